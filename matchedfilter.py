@@ -20,11 +20,16 @@ import matplotlib.pyplot as plt
 
 ### worker objects for threading
 
+# On linux, the workers get the progress directly from mics_pycbc_interface through report_progress (see PROGRESS_CALLBACK in the handlers).
+# report_progress is called at most once every progress_interval (config.ini) and tells mics_pycbc_interface, whether the user canceled.
+# On Windows, the handler ignores it and the progress goes through the progress files in the savepath, read once per second with a QTimer.
+
 class CreateTemplatesWorker(QThread):
 
 	exceptionSignal = pyqtSignal()
+	progressSignal = pyqtSignal(int, int, float)
 
-	def __init__(self, templatebank, array, path, basename, attribute, freq_domain, time_domain):
+	def __init__(self, templatebank, array, path, basename, attribute, freq_domain, time_domain, packed=False):
 		super().__init__()
 		self.templatebank = templatebank
 		self.array = array
@@ -33,6 +38,12 @@ class CreateTemplatesWorker(QThread):
 		self.attribute = attribute
 		self.freq_domain = freq_domain
 		self.time_domain = time_domain
+		self.packed = packed
+		self.canceled = False
+
+	def report_progress(self, done, total, elapsed):
+		self.progressSignal.emit(done, total, elapsed)
+		return self.canceled
 
 	def run(self):
 		'Create templates from the user-input.'
@@ -41,7 +52,7 @@ class CreateTemplatesWorker(QThread):
 			raise NotADirectoryError(errorstring)
 		else:
 			try:
-				self.templatebank.create_templates(self.array, self.path, self.basename, self.attribute, self.freq_domain, self.time_domain)
+				self.templatebank.create_templates(self.array, self.path, self.basename, self.attribute, self.freq_domain, self.time_domain, self.packed, progress_callback=self.report_progress)
 			except:
 				self.exceptionSignal.emit()
 
@@ -49,23 +60,86 @@ class CreateTemplatesWorker(QThread):
 class MatchedFilteringWorker(QThread):
 
 	exceptionSignal = pyqtSignal()
+	progressSignal = pyqtSignal(int, int, float)
 
 	def __init__(self, data, templatebank, debugmode):
 		super().__init__()
 		self.data = data
 		self.templatebank = templatebank
 		self.debugmode = debugmode
+		self.canceled = False
+
+	def report_progress(self, done, total, elapsed):
+		self.progressSignal.emit(done, total, elapsed)
+		return self.canceled
 
 	def run(self):
 		try:
-			self.data.matched_filter(self.templatebank, self.debugmode)
+			self.data.matched_filter(self.templatebank, self.debugmode, progress_callback=self.report_progress)
 		except:
 			self.exceptionSignal.emit()
 
 
+def read_progress(filename):
+	'Read (done, total, elapsed seconds) from a progress file of mics_pycbc_interface. None, if there is none (yet).'
+	try:
+		track_progress = np.loadtxt(filename)
+	except (OSError, ValueError):
+		return None
+	if track_progress.shape != (3,):
+		return None
+	return int(track_progress[0]), int(track_progress[1]), float(track_progress[2])
+
+def progress_text(action, unit, done, total, elapsed):
+	'Label text of a progress dialog with throughput and estimated time left.'
+	text = action+' in progress...\n'+str(done)+' of '+str(total)+' '+unit
+	if done > 0 and elapsed > 0:
+		rate = done/elapsed
+		left = (total-done)/rate
+		if left < 120:
+			left = str(int(round(left)))+' s'
+		elif left < 7200:
+			left = str(int(round(left/60)))+' min'
+		else:
+			left = str(round(left/3600, 1))+' h'
+		text += '\n'+str(round(rate, 2))+' '+unit+'/s, about '+left+' left'
+	return text
+
+
+### level of detail for large results
+
+# Scattering tens of thousands of points in 3D makes the results window slow to open and to rotate.
+# Above max_points (section resultsplot in config.ini), the (x,y)-plane is divided into bins and only the best match of every bin is shown,
+# either as scatter plot (lod = decimate) or as 2D heatmap (lod = heatmap). With lod = off, all points are scattered.
+
+def bin_indices(x, y, bins):
+	'Index of the bin of every point in a bins x bins grid over the range of x and y.'
+	def to_bins(values):
+		span = np.ptp(values)
+		if span == 0:
+			return np.zeros(len(values), dtype=np.int64)
+		return np.minimum(((values-values.min())/span*bins).astype(np.int64), bins-1)
+	return to_bins(x)*bins+to_bins(y)
+
+def decimate_results(x, y, z, max_points):
+	'Indices of the points to scatter: the best match in every bin of a grid with about max_points bins.'
+	bins = max(int(np.sqrt(max_points)), 1)
+	binned = bin_indices(x, y, bins)
+	order = np.lexsort((-z, binned))   # by bin, best match first
+	first = np.ones(len(order), dtype=bool)
+	first[1:] = binned[order][1:] != binned[order][:-1]
+	return order[first]
+
+def binned_max(x, y, z, bins):
+	'Best match in every bin of a bins x bins grid over x and y (nan for empty bins) and the edges of the grid.'
+	grid = np.full(bins*bins, np.nan)
+	np.fmax.at(grid, bin_indices(x, y, bins), z)
+	return grid.reshape((bins, bins)), (x.min(), x.max(), y.min(), y.max())
+
+
 class Canvas3DPlot(QMainWindow):
 
-	def __init__(self, results, attribute='individual', parent=None):
+	def __init__(self, results, attribute='individual', lod='decimate', max_points=5000, parent=None):
 		super().__init__(parent)
 
 		self.figure = Figure()
@@ -73,37 +147,39 @@ class Canvas3DPlot(QMainWindow):
 		self.setCentralWidget(self.canvas)
 		self.addToolBar(Qt.TopToolBarArea, NavigationToolbar(self.canvas, self)) # needed?
 
-		# shape arrays
-		L = len(results)
-		x = np.zeros(L)
-		y = np.zeros(L)
-		z = np.zeros(L)
-		for index in range(L):
-			x[index] = results[index][3]    # m1
-			y[index] = results[index][4]    # m2
-			z[index] = results[index][1]    # match
-
-		# plot
-		self.ax = self.figure.subplots(subplot_kw=dict(projection='3d'))
+		# shape arrays (results is a dictionary of columns, see load_results in the templatebank handler)
+		x = np.asarray(results['m1'], dtype=np.float64)
+		y = np.asarray(results['m2'], dtype=np.float64)
+		z = np.asarray(results['maxmatch'], dtype=np.float64)
+		filled = (x > 0) & (y > 0) & np.isfinite(z)   # results of a canceled run have rows of templates that were never filtered (masses 0)
+		x, y, z = x[filled], y[filled], z[filled]
 		if attribute == 'total':
-			M = x+y
-			r = y/x
-			self.ax.scatter(M,r,z, color='tab:purple')
-			self.ax.set_xlabel('total mass')
-			self.ax.set_ylabel('mass ratio')
-			self.ax.set_zlabel('match')
+			x, y = x+y, y/x
+			xlabel, ylabel = 'total mass', 'mass ratio'
 		elif attribute == 'chirp':
-			Mc = np.power(np.power(x*y, 3)/(x+y), 0.2)
-			r = y/x
-			self.ax.scatter(Mc,r,z, color='tab:purple')
-			self.ax.set_xlabel('chirp mass')
-			self.ax.set_ylabel('mass ratio')
-			self.ax.set_zlabel('match')
+			x, y = np.power(np.power(x*y, 3)/(x+y), 0.2), y/x
+			xlabel, ylabel = 'chirp mass', 'mass ratio'
+		else:
+			xlabel, ylabel = 'mass 1', 'mass 2'
+
+		# plot
+		num = len(z)
+		if lod == 'heatmap' and num > max_points:
+			self.ax = self.figure.subplots()
+			grid, extent = binned_max(x, y, z, max(int(np.sqrt(max_points)), 1))
+			image = self.ax.imshow(grid.T, origin='lower', extent=extent, aspect='auto', interpolation='nearest', cmap='viridis')
+			self.figure.colorbar(image, ax=self.ax, label='best match in bin')
+			self.ax.set_title('best match of '+str(num)+' templates')
 		else:
-			self.ax.scatter(x,y,z, color='tab:purple')
-			self.ax.set_xlabel('mass 1')
-			self.ax.set_ylabel('mass 2')
+			self.ax = self.figure.subplots(subplot_kw=dict(projection='3d'))
+			if lod == 'decimate' and num > max_points:
+				shown = decimate_results(x, y, z, max_points)
+				x, y, z = x[shown], y[shown], z[shown]
+				self.ax.set_title('best match per bin: '+str(len(z))+' of '+str(num)+' templates')
+			self.ax.scatter(x,y,z, color='tab:purple', depthshade=num<=max_points)
 			self.ax.set_zlabel('match')
+		self.ax.set_xlabel(xlabel)
+		self.ax.set_ylabel(ylabel)
 		self.canvas.draw_idle()
 
 
@@ -119,6 +195,7 @@ class Screen(QMainWindow):   # Superclass where the different Screens following
 		self.templatebank = templatebank
 		self.data = data
 		self.labels = labels
+		self.worker = None   # QThread of a running template creation or matched filtering
 		# settings for label length
 		self.label_maxlen = 48
 		self.label_indent = 8
@@ -394,6 +471,7 @@ class CreateScreen(Screen):
 		self.checkBox_Para2Code.setChecked(False)
 		self.checkBox_freq.setChecked(True)
 		self.checkBox_time.setChecked(False)
+		self.checkBox_packed.setChecked(False)
 
 	@pyqtSlot()
 	def chirpmass_info(self):
@@ -488,11 +566,15 @@ class CreateScreen(Screen):
 
 	def create_templates(self):
 
+		if self.worker is not None:   # the last run is still stopping after being canceled
+			return
+
 		# gather input for Worker
 		array = self.get_array()
 		basename = self.lineEdit_FilenameBase.text() 
 		freq_domain = self.checkBox_freq.isChecked()
 		time_domain = self.checkBox_time.isChecked()
+		packed = self.checkBox_packed.isChecked()
 
 		# set up the progress_dialog
 		self.progress_dialog = QProgressDialog("Preparing template creation,\n please wait...", "Cancel", 0, len(array[0])+1, self) # None instead of "Cancel" as CancelButtonText removes the cancel-button.
@@ -505,49 +587,57 @@ class CreateScreen(Screen):
 		# self.progress_dialog.canceled.connect(self.create_stop)  # for some reason this line triggers the mf_stop also when the progress_dialog.close gets called.
 
 		# create worker Thread
-		self.worker = CreateTemplatesWorker(self.templatebank, array, self.path, basename, self.attribute, freq_domain, time_domain)
+		self.worker = CreateTemplatesWorker(self.templatebank, array, self.path, basename, self.attribute, freq_domain, time_domain, packed)
 		self.worker.exceptionSignal.connect(self.create_exception)
+		self.worker.progressSignal.connect(self.create_show_progress)
 		self.worker.finished.connect(self.create_stop)
 		self.worker.start()
 
-		# setup timer to update the progress_dialog		
+		# setup timer to update the progress_dialog from the progress file (only if the handler can not report the progress directly)
 		self.timer = QTimer()
 		self.timer.timeout.connect(self.create_update_progress)
-		self.timer.start(1000)  # in ms - 1000 means the progress_bar gets updated once every second
+		if not handler.PROGRESS_CALLBACK:
+			self.timer.start(1000)  # in ms - 1000 means the progress_bar gets updated once every second
 
 	def create_update_progress(self):
-		if os.path.isfile(self.path+'00_progress_create.dat'):
-			track_progress = np.loadtxt(self.path+'00_progress_create.dat', dtype=int)
-			if len(track_progress)==2:
-				self.progress_dialog.setLabelText("creating templates...")
-				self.progress_bar.setMaximum(track_progress[1])
-				self.progress_dialog.setValue(track_progress[0])
-				if track_progress[0]==track_progress[1]:
-					self.timer.stop()
+		track_progress = read_progress(self.path+'00_progress_create.dat')
+		if track_progress is not None:
+			self.create_show_progress(*track_progress)
+
+	def create_show_progress(self, done, total, elapsed):
+		self.progress_dialog.setLabelText(progress_text('creating templates', 'templates', done, total, elapsed))
+		self.progress_bar.setMaximum(total)
+		self.progress_dialog.setValue(done)
+		if done==total:
+			self.timer.stop()
 
 	def create_cancel(self, event=None):
-		canceled = np.ones(1, dtype=bool)
-		canceled.tofile(self.path+'canceled.txt') # read as np.fromfile(self.path+'canceled.txt', dtype=bool)
+		# No waiting for the worker here (that froze the GUI): it stops at its next progress report and then create_stop cleans up.
+		self.worker.canceled = True
+		if not handler.PROGRESS_CALLBACK:
+			canceled = np.ones(1, dtype=bool)
+			canceled.tofile(self.path+'canceled.txt') # read as np.fromfile(self.path+'canceled.txt', dtype=bool)
 		self.timer.stop()
 		self.progress_dialog.close()
-		self.worker.wait()
-		self.worker.deleteLater()
-		try:
-			os.remove(self.path+'canceled.txt')
-		except FileNotFoundError:
-			pass
 		return
 
 	def create_stop(self, event=None):
 		self.timer.stop()
+		self.progress_dialog.canceled.disconnect(self.create_cancel)   # closing the dialog emits canceled, too
 		self.progress_dialog.close()
 		self.worker.wait()
 		self.worker.deleteLater()
+		self.worker = None
+		if os.path.isfile(self.path+'canceled.txt'):
+			try:
+				os.remove(self.path+'canceled.txt')
+			except (FileNotFoundError, PermissionError):
+				pass
 		if os.path.isfile(self.path+'00_progress_create.dat'):
 			try:
 				os.remove(self.path+'00_progress_create.dat')
 			except PermissionError:
-				print('No permission to remove 00_progress_mf.dat. Moving on.')
+				print('No permission to remove 00_progress_create.dat. Moving on.')
 		self.update_tmp_labels(self.path+' (new templates)')
 
 	def create_exception(self):
@@ -620,7 +710,7 @@ class DataScreen(Screen):
 
 			# make sure, matched filtering can be started (prevents overriding of existing results)
 			do_mf = True
-			if os.path.isfile(self.data.savepath+'00_matched_filtering_results.dat'):
+			if os.path.isfile(self.data.savepath+handler.RESULTS_FILENAME) or os.path.isfile(self.data.savepath+'00_matched_filtering_results.dat'):
 				do_mf = False
 				answer = QMessageBox.question(
 					self,
@@ -632,6 +722,8 @@ class DataScreen(Screen):
 					do_mf = True
 
 			# start matched filtering
+			if self.worker is not None:   # the last run is still stopping after being canceled
+				do_mf = False
 			if do_mf:
 				# set up the progress_dialog
 				self.progress_dialog = QProgressDialog("Preparing matched filtering,\n please wait...", "Cancel", 0, len(self.templatebank.list_of_templates)+2, self) # None instead of "Cancel" as CancelButtonText removes the cancel-button.
@@ -646,13 +738,15 @@ class DataScreen(Screen):
 				# create worker Thread
 				self.worker = MatchedFilteringWorker(self.data, self.templatebank, self.config.getboolean('main', 'debugmode'))
 				self.worker.exceptionSignal.connect(self.mf_exception)
+				self.worker.progressSignal.connect(self.mf_show_progress)
 				self.worker.finished.connect(self.mf_stop)
 				self.worker.start()
 
-				# setup timer to update the progress_dialog		
+				# setup timer to update the progress_dialog from the progress file (only if the handler can not report the progress directly)
 				self.timer = QTimer()
 				self.timer.timeout.connect(self.mf_update_progress)
-				self.timer.start(1000)  # in ms - 1000 means the progress_bar gets updated once every second
+				if not handler.PROGRESS_CALLBACK:
+					self.timer.start(1000)  # in ms - 1000 means the progress_bar gets updated once every second
 
 		else:
 			msg = QMessageBox()
@@ -664,34 +758,40 @@ class DataScreen(Screen):
 
 
 	def mf_update_progress(self):
-		if os.path.isfile(self.data.savepath+'00_progress_mf.dat'):
-			track_progress = np.loadtxt(self.data.savepath+'00_progress_mf.dat', dtype=int)
-			if len(track_progress)==2:
-				self.progress_dialog.setLabelText("matched filtering in progress...")
-				self.progress_bar.setMaximum(track_progress[1])
-				self.progress_dialog.setValue(track_progress[0])
-				if track_progress[0]==track_progress[1]:
-					self.timer.stop()
+		track_progress = read_progress(self.data.savepath+'00_progress_mf.dat')
+		if track_progress is not None:
+			self.mf_show_progress(*track_progress)
+
+	def mf_show_progress(self, done, total, elapsed):
+		self.progress_dialog.setLabelText(progress_text('matched filtering', 'templates', done, total, elapsed))
+		self.progress_bar.setMaximum(total)
+		self.progress_dialog.setValue(done)
+		if done==total:
+			self.timer.stop()
 
 	def mf_cancel(self):
-		canceled = np.ones(1, dtype=bool)
-		canceled.tofile(self.data.savepath+'canceled.txt') # read as np.fromfile(self.path+'canceled.txt', dtype=bool)
+		# No waiting for the worker here (that froze the GUI): it stops at its next progress report and then mf_stop cleans up.
+		self.worker.canceled = True
+		if not handler.PROGRESS_CALLBACK:
+			canceled = np.ones(1, dtype=bool)
+			canceled.tofile(self.data.savepath+'canceled.txt') # read as np.fromfile(self.path+'canceled.txt', dtype=bool)
 		self.timer.stop()
 		self.progress_dialog.close()
-		self.worker.wait()
-		self.worker.deleteLater()
-		try:
-			os.remove(self.data.savepath+'canceled.txt')
-		except FileNotFoundError:
-			pass
 		return
 
 	def mf_stop(self, event=None):
 		self.timer.stop()
+		self.progress_dialog.canceled.disconnect(self.mf_cancel)   # closing the dialog emits canceled, too
 		self.progress_dialog.close()
 		self.worker.wait()
 		self.worker.deleteLater()
-		if os.path.isfile(self.data.savepath+'00_progress_create.dat'):
+		self.worker = None
+		if os.path.isfile(self.data.savepath+'canceled.txt'):
+			try:
+				os.remove(self.data.savepath+'canceled.txt')
+			except (FileNotFoundError, PermissionError):
+				pass
+		if os.path.isfile(self.data.savepath+'00_progress_mf.dat'):
 			try:
 				os.remove(self.data.savepath+'00_progress_mf.dat')
 			except FileNotFoundError:
@@ -723,11 +823,13 @@ class DataScreen(Screen):
 			elif self.ButtonGroup_Attribute.checkedId() != 1:
 				raise ValueError('Unexpected behaviour of the ButtonGroup_Attribute: self.ButtonGroup_Attribute.checkedId() = ',self.ButtonGroup_Attribute.checkedId())
 
-			# load results
-			results_filename = self.data.savepath+'00_matched_filtering_results.dat'
+			# load results (the .dat-file only, if there is no .npz, e.g. from older versions)
+			results_filename = self.data.savepath+handler.RESULTS_FILENAME
+			if not os.path.isfile(results_filename):
+				results_filename = self.data.savepath+'00_matched_filtering_results.dat'
 			if os.path.isfile(results_filename): 														# should I better do this in try/except style?
-				results = np.loadtxt(results_filename,  dtype={'names': ('name', 'match', 'time', 'm1', 'm2', 'M', 'r', 'Mc'), 'formats': ('S5', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4')})
-				self.canvas = Canvas3DPlot(results, attribute)
+				results = handler.load_results(results_filename)
+				self.canvas = Canvas3DPlot(results, attribute, self.config.get('resultsplot', 'lod', fallback='off'), self.config.getint('resultsplot', 'max_points', fallback=5000))
 				self.canvas.show()
 
 			else:
@@ -2,19 +2,32 @@
 
 from pycbc.waveform import get_td_waveform,td_approximants
 from pycbc import types
-from pycbc.filter import matched_filter_core, sigmasq #, matched_filter, match
+from pycbc.filter import sigmasq #, matched_filter, matched_filter_core, match
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import os
+import io
+import atexit
+import time
+import contextlib
+import functools
+import traceback
+import hashlib
+import multiprocessing
+import multiprocessing.connection
 
 import wave
 import samplerate  # sadly samplerate can no longer be used as variable name - they're all called srate now.
 import h5py
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from fractions import Fraction
 from datetime import datetime
 from configparser import ConfigParser
 from json import loads as jsonloads
+import json
 
 
 ### Global definitions
@@ -26,6 +39,8 @@ debugmode = config.getboolean('main', 'debugmode')
 
 # approximants for template creation
 APX_DEFAULT = config.get('approximants', 'apx_default')
+APX_CACHE_FILENAME = '00_approximant_cache.json'  # saved next to the created templates
+APX_CACHE_EXPIRY = 30*24*3600.                    # in s; approximants that only failed in a mass region are tried there again after this time
 if not config.getboolean('approximants', 'use_backup'):
 	APX_ALL = td_approximants()
 	APX_FORBIDDEN = jsonloads(config.get('approximants', 'apx_forbidden')) # Trying these apxs caused python to crash with a "Segmentation fault (core dumped)" - an exception it could not handle.
@@ -33,6 +48,54 @@ if not config.getboolean('approximants', 'use_backup'):
 else:
 	APX_ALLOWED = jsonloads(config.get('approximants', 'apx_backup'))
 
+# number of worker processes for matched filtering (0 means one per cpu core)
+WORKERS = config.getint('performance', 'workers', fallback=1)
+if WORKERS < 1:
+	WORKERS = os.cpu_count()
+
+# maximum size of all template data kept in memory at the same time (in MB)
+TEMPLATE_CACHE_MB = config.getfloat('performance', 'template_cache_mb', fallback=512)
+
+# create every template in its own child process (up to WORKERS at a time), so crashing or hanging approximants only lose that template
+ISOLATED_CREATION = config.getboolean('performance', 'isolated_creation', fallback=False)
+TEMPLATE_TIMEOUT = config.getfloat('performance', 'template_timeout', fallback=300)   # in s
+
+# progress is reported (and canceling checked) at most once per progress_interval, not for every template
+PROGRESS_INTERVAL = config.getfloat('performance', 'progress_interval', fallback=0.5)   # in s
+
+# results of the matched filtering are saved as .npz (one array per column); the .dat-tables are optional
+RESULTS_FILENAME = '00_matched_filtering_results.npz'
+RESULTS_TEXT_EXPORT = config.getboolean('results', 'text_export', fallback=True)
+# keep the match of every template with every segment in 00_segment_results.hdf for later queries (see Per-segment results store)
+SEGMENT_STORE = config.getboolean('results', 'segment_store', fallback=False)
+SEGMENT_STORE_FILENAME = '00_segment_results.hdf'
+# remember the results of every template with the data, so a rerun (e.g. with an extended template bank) only filters new templates
+FILTER_CACHE = config.getboolean('results', 'filter_cache', fallback=False)
+FILTER_CACHE_DIR = '00_filter_cache/'
+
+# resampled tracks of all recordings are cached in one directory, so reruns skip loading and resampling (0 disables the cache)
+# It is in the MatchedFilter directory (on Windows mounted into the container at the same place, see templatebank_handler_win).
+RESAMPLE_CACHE_MB = config.getfloat('performance', 'resample_cache_mb', fallback=0)   # limit for the whole cache, not per recording
+RESAMPLE_CACHE_DIR = os.getcwd().rstrip('/')+'/00_resampled/'
+
+# converter for resampling the data: sinc_best, sinc_medium, sinc_fastest (libsamplerate) or polyphase (numpy, for integer samplerates)
+RESAMPLER = config.get('performance', 'resampler', fallback='sinc_best')
+RESAMPLERS = ['sinc_best', 'sinc_medium', 'sinc_fastest', 'polyphase']
+if not RESAMPLER in RESAMPLERS:
+	raise ValueError('resampler can only be: '+', '.join(RESAMPLERS)+'. But I got: '+RESAMPLER)
+
+# precision of data and templates in the matched filtering: double (float64/complex128) or single (float32/complex64, half the memory)
+PRECISION = config.get('performance', 'precision', fallback='double')
+REAL_DTYPES = {'double': np.float64, 'single': np.float32}
+if not PRECISION in REAL_DTYPES:
+	raise ValueError('precision can only be: '+', '.join(REAL_DTYPES)+'. But I got: '+PRECISION)
+
+# live matched filtering of a growing recording
+LIVE_THRESHOLD = config.getfloat('live', 'match_threshold', fallback=0.4)   # matches above are reported immediately
+LIVE_POLL_INTERVAL = config.getfloat('live', 'poll_interval', fallback=0.2) # in s; how often to look for new samples
+LIVE_IDLE_TIMEOUT = config.getfloat('live', 'idle_timeout', fallback=10)   # in s; stop, if the recording did not grow for this long
+LIVE_CHUNK_FRAMES = 4096                                      # read in small chunks to keep the latency low
+
 
 ### Redefine classes inside the container
 #   -------------------------------------
@@ -41,20 +104,115 @@ class TemplateBank:
 	def __init__(self):
 		self.list_of_templates = []
 	
-	def add_template(self, bankpath, filename):
-		'Add a single file to the TemplateBank.'
-		self.list_of_templates.append(Template(bankpath, filename))
+	def add_template(self, bankpath, filename, row=None):
+		'Add a single file (or a single row of a packed template bank) to the TemplateBank.'
+		self.list_of_templates.append(Template(bankpath, filename, row))
+
+	def add_packed_bank(self, bankpath, filename):
+		'Add all templates of a packed template bank to the TemplateBank.'
+		bank = load_packed_bank(bankpath+filename)
+		for row,name in enumerate(bank['name']):
+			if name:  # unused rows have no name
+				self.add_template(bankpath, filename, row)
 
 class Template:
-	def __init__(self, path, filename):
+	def __init__(self, path, filename, row=None):
 		self.path = path
 		self.filename = filename
-		self.shortname = filename[:-4]
+		self.row = row
 
-		self.frequency_series, self.m1, self.m2 = load_FrequencySeries(self.path+self.filename)
+		# only the metadata is loaded here, the FrequencySeries is loaded when it is needed (see frequency_series below).
+		if row is None:
+			self.shortname = filename[:-4]
+			self.m1, self.m2, self.metadata = load_FrequencySeries_metadata(self.path+self.filename)
+		else:
+			self.m1, self.m2, self.shortname, self.metadata = load_packed_metadata(self.path+self.filename, row)
+
+	@property
+	def frequency_series(self):
+		'The FrequencySeries of the template; loaded on demand through the least recently used template_cache.'
+		return template_cache.get((self.path+self.filename, self.row), self.load_frequency_series)
+
+	def spectrum(self, precision='double'):
+		'The template for the matched filtering: the FrequencySeries in double precision, a complex64 array in single precision (cached on its own).'
+		if precision == 'double':
+			return self.frequency_series
+		return template_cache.get((self.path+self.filename, self.row, precision), lambda: np.asarray(self.load_frequency_series(), dtype=np.complex64))
+
+	def load_frequency_series(self):
+		if self.row is None:
+			frequency_series, _, _ = load_FrequencySeries(self.path+self.filename)
+		else:
+			frequency_series, _, _, _ = load_FrequencySeries_packed(self.path+self.filename, self.row)
+		return frequency_series
+
+	def filter_metadata(self):
+		'Offset, sigmasq and nonzero frequency band of the template. Templates created by older versions get them computed and saved now.'
+		if self.metadata is None:
+			self.metadata = compute_filter_metadata(self.frequency_series)
+			if self.row is None:
+				save_filter_metadata(self.path+self.filename, self.metadata)
+		return self.metadata
+
+	def content_hash(self):
+		'Hash of the content of the template (see Incremental results cache), saved with the filter metadata. Templates of older versions get it computed and saved now.'
+		metadata = self.filter_metadata()
+		if not 'content_hash' in metadata:
+			metadata['content_hash'] = content_hash(self.load_frequency_series())   # not through the template_cache, the workers load it anyway
+			if self.row is None:
+				save_filter_metadata(self.path+self.filename, metadata)
+		return metadata['content_hash']
+
+class TemplateCache:
+	'Least recently used cache for the FrequencySeries of templates, bounded by the total size of the cached data.'
+	def __init__(self, maxsize):
+		self.maxsize = maxsize  # in bytes
+		self.size = 0
+		self.entries = OrderedDict()
+
+	def get(self, key, loader):
+		'Return the cached entry for key or load it with loader() and cache it.'
+		if key in self.entries:
+			self.entries.move_to_end(key)
+			return self.entries[key]
+		value = loader()
+		nbytes = np.asarray(value).nbytes   # FrequencySeries or (in single precision) numpy array
+		if nbytes <= self.maxsize:
+			self.entries[key] = value
+			self.size += nbytes
+			while self.size > self.maxsize:
+				_, oldest = self.entries.popitem(last=False)
+				self.size -= np.asarray(oldest).nbytes
+		return value
+
+	def clear(self):
+		self.entries.clear()
+		self.size = 0
+
+template_cache = TemplateCache(TEMPLATE_CACHE_MB*1024**2)
+
+class GeneratedTemplate:
+	'A template that was created during a search and only exists in memory. It can be used in the matched filtering just as Template.'
+	def __init__(self, shortname, m1, m2, frequency_series):
+		self.shortname = shortname
+		self.m1 = m1
+		self.m2 = m2
+		self.frequency_series = frequency_series
+		self.metadata = compute_filter_metadata(frequency_series)
+
+	def filter_metadata(self):
+		return self.metadata
+
+	def content_hash(self):
+		return self.metadata['content_hash']
+
+	def spectrum(self, precision='double'):
+		if precision == 'double':
+			return self.frequency_series
+		return np.asarray(self.frequency_series, dtype=np.complex64)
 
 class Data:
-	def __init__(self, datapath, filename, savepath, preferred_srate, segment_duration, flag_show):
+	def __init__(self, datapath, filename, savepath, preferred_srate, segment_duration, flag_show, converter=RESAMPLER, precision=PRECISION):
 		self.datapath = datapath
 		self.filename = filename
 		self.shortname = filename[:-4]
@@ -63,12 +221,78 @@ class Data:
 		self.preferred_srate = preferred_srate
 		self.segment_duration = segment_duration
 		self.flag_show = flag_show
+		self.converter = converter
+		self.precision = precision
+
+		cachepath = RESAMPLE_CACHE_DIR if RESAMPLE_CACHE_MB > 0 else None
+		self.segments = segment_data(datapath+filename, preferred_srate, segment_duration, cachepath, converter, REAL_DTYPES[precision])
 
-		self.segments = segment_data(datapath+filename, preferred_srate, segment_duration)
+		# the segments never change, so their spectra and norms are computed only once and then reused for every template.
+		self.delta_t = self.segments[0].delta_t
+		self.delta_f = 1./(len(self.segments[0])*self.delta_t)
+		self.start_times = segment_start_times(self.segments)   # in s (see Float time model below)
+		self.segment_spectra = stack_spectra(self.segments, REAL_DTYPES[precision])
+		self.segment_norms = sigmasq_segments(self.segment_spectra, self.delta_f)
 
 class NaNError(Exception):
 	pass
 
+### Progress and cancellation
+#   -------------------------
+
+# The long running functions (template creation, matched filtering, detection, hierarchical search) report their progress through a Progress object.
+# With a callback (on linux, the GUI runs mpi in the same process), the callback gets (done, total, elapsed seconds) and returns True, if the user canceled.
+# Without a callback (inside the docker container), the progress is written to a file in savepath that the GUI reads and canceling is the file canceled.txt.
+# Either way, it happens at most once every PROGRESS_INTERVAL seconds, so the filesystem is not touched for every template.
+# If the total is not known (live matched filtering of a growing recording), it is 0.
+
+class Progress:
+	'Throttled progress report and cancel check of a long running function.'
+
+	def __init__(self, savepath, filename, total, callback=None, interval=PROGRESS_INTERVAL):
+		self.savepath = savepath
+		self.filename = filename    # progress file (only without callback)
+		self.total = total
+		self.callback = callback
+		self.interval = interval
+		self.start = time.time()
+		self.last = None
+		self.done = 0
+		self.canceled = False
+		self.update(0)
+
+	def update(self, done, force=False):
+		'Report that done of total steps are done. Returns True, if the user canceled.'
+		now = time.time()
+		self.done = done
+		if force or self.last is None or (self.total and done >= self.total) or now-self.last >= self.interval:
+			self.last = now
+			if self.callback is not None:
+				self.canceled = bool(self.callback(done, self.total, now-self.start)) or self.canceled
+			else:
+				write_progress(self.savepath+self.filename, done, self.total, now-self.start)
+				self.canceled = self.canceled or os.path.isfile(self.savepath+'canceled.txt')
+		return self.canceled
+
+	def check(self):
+		'Cancel check without new progress, e.g. while waiting for data. Returns True, if the user canceled.'
+		return self.update(self.done)
+
+	def reset_cancel(self):
+		'Remove canceled.txt after the function stopped, so the next run is not canceled right away.'
+		if os.path.isfile(self.savepath+'canceled.txt'):
+			os.remove(self.savepath+'canceled.txt')
+
+def write_progress(filename, done, total, elapsed):
+	'Write the progress file read by the GUI: done, total and elapsed seconds, one per line.'
+	# written to a temporary file first, so the GUI never reads a half-written file
+	try:
+		with open(filename+'.tmp', 'w') as progressfile:
+			progressfile.write(str(int(done))+'\n'+str(int(total))+'\n'+str(round(elapsed, 3))+'\n')
+		os.replace(filename+'.tmp', filename)
+	except OSError:
+		pass   # e.g. the GUI is just reading the file on windows; the next update will do.
+
 ### Data handling functions
 #   -----------------------
 
@@ -137,6 +361,48 @@ def load_wav( filename, channel='unclear', debugmode=False ):
 
 	return srate,track
 
+def read_wav_chunks( filename, channel='unclear', chunk_frames=2**18 ):
+	'Yield a single track from a wav-file chunk by chunk (numpy-arrays), without loading the whole file. Channels as in load_wav.'
+	if not channel in ['mono', 'left', 'right', 'average', 'greater', 'unclear']:
+		raise ValueError('channel can only be: mono, left, right, average, greater, unclear. But I got: ',channel)
+
+	with wave.open(filename) as snd:
+		nchannels = snd.getnchannels()
+		dtype = f'int{snd.getsampwidth()*8}'
+
+		# relabel the channel, if 'unclear'
+		if channel == 'unclear':
+			if nchannels == 2:
+				channel = 'greater'
+			if nchannels == 1:
+				channel = 'mono'
+
+		# 'greater' needs a first pass through the whole file to compare both channels (calculated exactly as in load_wav)
+		if channel == 'greater':
+			sum_left = 0
+			sum_right = 0
+			for buffer in iter(lambda: snd.readframes(chunk_frames), b''):
+				stereo = np.reshape(np.frombuffer(buffer, dtype=dtype), (-1,nchannels))
+				sum_left += np.sum(np.square(stereo[:,0]))
+				sum_right += np.sum(np.square(stereo[:,1]))
+			channel = 'right' if sum_right > sum_left else 'left'
+			snd.rewind()
+
+		for buffer in iter(lambda: snd.readframes(chunk_frames), b''):
+			yield select_channel(np.frombuffer(buffer, dtype=dtype), nchannels, channel)
+
+def select_channel( interleaved, nchannels, channel ):
+	'Return the track of channel (mono, left, right or average) from interleaved samples.'
+	if channel == 'mono':
+		return interleaved
+	stereo = np.reshape(interleaved, (-1,nchannels))
+	if channel == 'left':
+		return stereo[:,0]
+	elif channel == 'right':
+		return stereo[:,1]
+	else: # 'average'
+		return 0.5*(stereo[:,0]+stereo[:,1])
+
 
 ### Functions to handle lal.gpstime to datetime conversions
 #   -------------------------------------------------------
@@ -169,34 +435,238 @@ def get_end_time(timeseries):
 	return end_time
 
 
+### Float time model
+#   ----------------
+
+# Inside the matched filtering, times are plain floats in s, counted from the start of the loaded data (= epoch 0 of the first segment).
+# Segment i starts at i*0.5*segment_duration and templates have t=0 at merger, so no conversions through lal.gpstime and datetime are necessary.
+# get_end_time() above resolves microseconds only. end_time_seconds() keeps this resolution, so all results stay the same as with get_end_time().
+
+def end_time_seconds(timeseries):
+	'Get the property end_time of a TimeSeries in s (float, resolved to microseconds as in get_end_time).'
+	return round(float(timeseries.end_time), 6)
+
+def segment_start_times(segments):
+	'Return the start times of all segments in s as a numpy array.'
+	return np.array([float(segment.start_time) for segment in segments])
+
+
 
 ### Functions to load data and do the matched filtering
 #   ---------------------------------------------------
 
-def segment_data(filename, preferred_srate=4096, segment_duration=1):
-	'Load a wav-file and return it as a list of TimeSeries of proper duration and samplerate for further analysis.'
-	# preferred_srate should be a multiple of two (see definition of segment_lenght in l.188)
+def iter_resampled(filename, preferred_srate=4096, chunk_frames=2**18, converter=RESAMPLER):
+	'Load a wav-file chunk by chunk and yield it resampled with preferred_srate (as float64 arrays).'
+	with wave.open(filename) as snd:
+		srate = snd.getframerate()
+	return resample_chunks(read_wav_chunks(filename, channel='unclear', chunk_frames=chunk_frames), srate, preferred_srate, chunk_frames, converter)
 
-	# load and resample with preferred_srate
-	srate,track = load_wav(filename, channel='unclear')
+def resample_chunks(chunks, srate, preferred_srate=4096, chunk_frames=2**18, converter=RESAMPLER):
+	'Resample a track coming in chunks (any iterable of numpy-arrays) from srate to preferred_srate and yield it chunk by chunk (as float64 arrays).'
+	# The values are identical to resampling the whole track at once with samplerate.resample(), but memory stays bounded.
 	ratio = preferred_srate/srate
-	converter = 'sinc_best'
-	newtrack = samplerate.resample(track, ratio, converter)  # resampling with pycbc did not work, since the recording samplerate is not right. (I guess would have to be a multiple of 2.)
-	newtrack = newtrack.astype(np.float64)
-	
-	# fill with zeros till length is a multiple of segment_length / 2
+	if converter == 'polyphase':
+		resampler = PolyphaseResampler(srate, preferred_srate)
+	else:
+		resampler = samplerate.Resampler(converter, channels=1)  # resampling with pycbc did not work, since the recording samplerate is not right. (I guess would have to be a multiple of 2.)
+	len_in = 0
+	len_out = 0
+	for track in chunks:
+		newtrack = resampler.process(track.astype(np.float32), ratio, end_of_input=False)
+		len_in += len(track)
+		len_out += len(newtrack)
+		yield newtrack.astype(np.float64)
+	# samplerate.resample() pads the end of the input with zeros and returns int(len_in*ratio) samples. Do the same.
+	len_total = int(len_in*ratio)
+	while len_out < len_total:
+		newtrack = resampler.process(np.zeros(chunk_frames, dtype=np.float32), ratio, end_of_input=False)[:len_total-len_out]
+		len_out += len(newtrack)
+		yield newtrack.astype(np.float64)
+
+
+class PolyphaseResampler:
+	'Resampling by a rational factor up/down with a polyphase windowed-sinc filter in numpy. Same process() as samplerate.Resampler, so it can be used in its place.'
+	# Output sample m sits at position m*down/up of the input. Of the (upsampled) lowpass filter h only every up-th coefficient meets a nonzero input sample,
+	# so every output sample is the dot product of the input before it with one of the up phases of h. 
+	# The filter is delayed by half its length, so the output is aligned with the input (as with libsamplerate).
+	def __init__(self, srate, preferred_srate, zero_crossings=16, rolloff=0.95, beta=8.6):
+		ratio = Fraction(int(preferred_srate), int(srate))
+		self.up = ratio.numerator
+		self.down = ratio.denominator
+		# Kaiser windowed sinc lowpass at the upsampled rate, cut off below the lower of both nyquist frequencies.
+		cutoff = rolloff*0.5/max(self.up, self.down)         # in cycles per upsampled sample
+		half = int(np.ceil(zero_crossings/(2*cutoff)))
+		k = np.arange(-half, half+1)
+		h = self.up*2*cutoff*np.sinc(2*cutoff*k)*np.kaiser(2*half+1, beta)
+		self.taps = int(np.ceil(len(h)/self.up))
+		h = np.concatenate((h, np.zeros(self.taps*self.up-len(h))))
+		self.phases = h.reshape((self.taps, self.up)).T[:,::-1].copy()   # phases[p, taps-1-j] = h[p+j*up]; reversed to multiply with the input in its own order
+		self.delay = half                                    # in upsampled samples
+		self.history = np.zeros(self.taps)                   # input samples kept from the last call (also serves as zeros before the start)
+		self.history_start = -self.taps                      # input index of history[0]
+		self.len_out = 0                                     # number of output samples created so far
+
+	def process(self, input_data, ratio=None, end_of_input=False):
+		'Resample the next chunk of input and return all output samples that can be computed so far.'
+		# ratio and end_of_input are only there for compatibility with samplerate.Resampler; the ratio is fixed and the end is padded with zeros by the caller.
+		x = np.concatenate((self.history, np.asarray(input_data, dtype=np.float64)))
+		len_in = self.history_start+len(x)                   # input samples received so far
+		# output m needs the input up to index (m*down+delay)//up
+		len_out = max((len_in*self.up-1-self.delay)//self.down+1, self.len_out)
+		m = np.arange(self.len_out, len_out)
+		position = m*self.down+self.delay
+		last = position//self.up-self.history_start          # index in x of the newest input sample used by output m
+		phase = position%self.up
+		output = np.empty(len(m))
+		for start in range(0, len(m), 4096):   # in blocks, to keep the temporary (block x taps) array small
+			end = min(start+4096, len(m))
+			window = np.lib.stride_tricks.sliding_window_view(x, self.taps)[last[start:end]-self.taps+1]
+			output[start:end] = np.einsum('ij,ij->i', window, self.phases[phase[start:end]])
+		self.len_out = len_out
+		# keep what the next output samples still need
+		first_needed = (len_out*self.down+self.delay)//self.up-self.taps+1
+		keep = min(max(len_in-first_needed, 0), len(x))
+		self.history = x[len(x)-keep:]
+		self.history_start = len_in-keep
+		return output
+
+
+def iter_segments(filename, preferred_srate=4096, segment_duration=1, chunk_frames=2**18, cachepath=None, converter=RESAMPLER, dtype=np.float64):
+	'Load a wav-file chunk by chunk and yield it as overlapping TimeSeries of proper duration and samplerate for further analysis.'
+	# With a cachepath, the resampled track is taken from (or saved to) the resample cache there.
+	if cachepath is None:
+		newtracks = iter_resampled(filename, preferred_srate, chunk_frames, converter)
+	else:
+		newtracks = cached_resampled(filename, preferred_srate, cachepath, chunk_frames, converter)
+	return segment_chunks(newtracks, preferred_srate, segment_duration, dtype)
+
+def segment_chunks(newtracks, preferred_srate=4096, segment_duration=1, dtype=np.float64):
+	'Yield overlapping TimeSeries of proper duration from a resampled track coming in chunks, each as soon as it is complete.'
+	# preferred_srate should be a multiple of two (see definition of segment_length below)
+	# The segments have the type dtype (float32 for single precision); the resampling itself is always done in double precision.
 	segment_length = segment_duration*preferred_srate  # this should be a multiple of two!
-	k = max(int(np.ceil(len(newtrack)/(0.5*segment_length))), 2)
-	newtrack.resize(int(k*0.5*segment_length), refcheck=False)
+	buffer = np.zeros(0)
+	buffer_start = 0    # position of buffer[0] in the resampled track
+	len_track = 0
+	index = 0
+
+	# yield every segment as soon as it is complete
+	for newtrack in newtracks:
+		buffer = np.concatenate((buffer, newtrack))
+		len_track += len(newtrack)
+		while int(index*0.5*segment_length)+segment_length <= len_track:
+			start = int(index*0.5*segment_length)-buffer_start
+			yield types.timeseries.TimeSeries(buffer[start:start+segment_length].astype(dtype),delta_t=1./preferred_srate,epoch=index*0.5*segment_duration)
+			index += 1
+		drop = int(index*0.5*segment_length)-buffer_start  # samples no following segment needs anymore
+		buffer = buffer[drop:]
+		buffer_start += drop
+
+	# fill with zeros till length is a multiple of segment_length / 2 and yield the remaining segments
+	k = max(int(np.ceil(len_track/(0.5*segment_length))), 2)
+	buffer = np.concatenate((buffer, np.zeros(int(k*0.5*segment_length)-len_track)))
+	while index < k-1:
+		start = int(index*0.5*segment_length)-buffer_start
+		yield types.timeseries.TimeSeries(buffer[start:start+segment_length].astype(dtype),delta_t=1./preferred_srate,epoch=index*0.5*segment_duration)
+		index += 1
+
+
+def segment_data(filename, preferred_srate=4096, segment_duration=1, cachepath=None, converter=RESAMPLER, dtype=np.float64):
+	'Load a wav-file and return it as a list of TimeSeries of proper duration and samplerate for further analysis.'
+	return list(iter_segments(filename, preferred_srate, segment_duration, cachepath=cachepath, converter=converter, dtype=dtype))
+
 
-	# cut in overlapping pieces of length segment_length
-	data_segments = []
-	for index in range(k-1):
-		start = int(index*0.5*segment_length)
-		end = start+segment_length
-		data_segments += [types.timeseries.TimeSeries(newtrack[start:end],delta_t=1./preferred_srate,epoch=index*0.5*segment_duration)]
+# The resample cache holds resampled tracks as .npy-files named after the content of the wav-file, the samplerate and the converter.
+# A small index maps filename, size and modification time to the content hash, so a rerun does not even have to read the wav-file to find its track.
+# If the cache gets bigger than RESAMPLE_CACHE_MB, the least recently used tracks are deleted.
+# Several processes (e.g. of matched_filter_batch) can use the cache at the same time, so temporary files get the process id.
 
-	return data_segments
+RESAMPLE_CACHE_INDEX = '00_index.json'
+
+def file_hash(filename):
+	'Return the sha1 hash of the content of a file (read in blocks).'
+	sha = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		for block in iter(lambda: f.read(2**20), b''):
+			sha.update(block)
+	return sha.hexdigest()
+
+def indexed_file_hash(filename, indexfile):
+	'Return file_hash(filename), looked up in the json-file indexfile by filename, size and modification time (and added there, if it is new).'
+	stat = os.stat(filename)
+	filekey = os.path.abspath(filename)+'|'+str(stat.st_size)+'|'+str(stat.st_mtime_ns)
+	try:
+		with open(indexfile) as f:
+			index = json.load(f)
+	except (OSError, ValueError):
+		index = {}
+	if not filekey in index:
+		index[filekey] = file_hash(filename)
+		tmpfile = indexfile+'.'+str(os.getpid())+'.tmp'
+		try:
+			with open(tmpfile, 'w') as f:
+				json.dump(index, f)
+			os.replace(tmpfile, indexfile)
+		except OSError as err:
+			print('Could not update the index '+indexfile+': '+repr(err))
+	return index[filekey]
+
+def resample_cache_key(filename, preferred_srate, cachepath, converter=RESAMPLER):
+	'Return the name of the cached resampled track of a wav-file (without .npy).'
+	return indexed_file_hash(filename, cachepath+RESAMPLE_CACHE_INDEX)+'_'+str(preferred_srate)+'_'+converter
+
+def cached_resampled(filename, preferred_srate, cachepath, chunk_frames=2**18, converter=RESAMPLER):
+	'Yield the resampled track of a wav-file chunk by chunk from the resample cache in cachepath. If it is not cached yet, it is resampled and saved on the way.'
+	mkdir(cachepath, relative=False)
+	path = cachepath+resample_cache_key(filename, preferred_srate, cachepath, converter)+'.npy'
+	if os.path.isfile(path):
+		os.utime(path)   # mark as recently used
+		track = np.load(path, mmap_mode='r')
+		for start in range(0, len(track), chunk_frames):
+			yield np.array(track[start:start+chunk_frames])
+		return
+
+	# resample and write into a temporary file, which only replaces the cache file when it is complete.
+	with wave.open(filename) as snd:
+		length = int(snd.getnframes()*preferred_srate/snd.getframerate())   # as returned by samplerate.resample()
+	tmppath = path+'.'+str(os.getpid())+'.tmp'
+	track = np.lib.format.open_memmap(tmppath, mode='w+', dtype=np.float64, shape=(length,))
+	position = 0
+	complete = False
+	try:
+		for newtrack in iter_resampled(filename, preferred_srate, chunk_frames, converter):
+			track[position:position+len(newtrack)] = newtrack
+			position += len(newtrack)
+			yield newtrack
+		complete = position == length
+	finally:
+		track.flush()
+		del track
+		if complete:
+			os.replace(tmppath, path)
+			evict_resample_cache(cachepath, RESAMPLE_CACHE_MB*1024**2, keep=path)
+		else:
+			os.remove(tmppath)
+
+def evict_resample_cache(cachepath, maxsize, keep=None):
+	'Delete the least recently used tracks in the resample cache until it is not bigger than maxsize (in bytes).'
+	tracks = []
+	for f in os.listdir(cachepath):
+		if f.endswith('.npy'):
+			try:
+				stat = os.stat(cachepath+f)
+			except FileNotFoundError:  # just deleted by another process
+				continue
+			tracks.append((stat.st_mtime, stat.st_size, cachepath+f))
+	tracks.sort()
+	size = sum(track[1] for track in tracks)
+	for _, tracksize, path in tracks:
+		if size <= maxsize:
+			break
+		if path != keep:
+			size -= tracksize
+			with contextlib.suppress(FileNotFoundError):
+				os.remove(path)
 
 
 def make_template( m1, m2, apx='SEOBNRv4', srate=4096, duration=1.0, flag_show=False ):
@@ -230,35 +700,154 @@ def make_template( m1, m2, apx='SEOBNRv4', srate=4096, duration=1.0, flag_show=F
 	return hp_freq, hp
 
 
-def make_template_any_apx( m1, m2, srate=4096, duration=1.0, flag_show=False, errorname='nameless_template' ):
-	'Create a template. Try all allowed approximants (apx), if default apx fails.'
-	try:
-		hp_freq, hp = make_template(m1, m2, apx=APX_DEFAULT, srate=srate, duration=duration, flag_show=flag_show)
-		if np.isnan(hp_freq[0]) or np.isnan(hp[0]):
-			raise NaNError
-		return hp_freq, hp
-	except:
-		print('Creating template with default approximant ('+APX_DEFAULT+') failed. Trying other ones.')
-		for apx in APX_ALLOWED:
+class ApproximantCache:
+	'Persistent record of the approximants that worked or failed (and how long they took) in different mass regions.'
+
+	# The records are saved as json in a file, e.g. next to the templates, to survive across runs and containers.
+	# In the file, records[region][apx] = [number of successes, number of failures, total time spent in s, time of the last failure]
+	# Only failures saying that the approximant can not handle the masses (NaNError, RuntimeError, crashes) are recorded, no timeouts.
+	# And they expire: an approximant that never worked in a region is only skipped there for APX_CACHE_EXPIRY after its last failure.
+
+	def __init__(self, path=None):
+		self.path = path            # None: not persistent
+		self.records = self.load()
+		self.new_records = []       # records since loading or saving; child processes send them to their parent
+		self.connection = None      # set in child processes to announce every attempt to the parent (in case the child crashes)
+
+	def load(self):
+		if self.path and os.path.isfile(self.path):
 			try:
-				hp_freq, hp = make_template(m1,m2,apx=apx, srate=srate, duration=duration, flag_show=flag_show)
-				if np.isnan(hp_freq[0]) or np.isnan(hp[0]):
-					raise NaNError
+				with open(self.path, 'r') as f:
+					return json.load(f)
+			except ValueError:
+				print('Could not read the approximant cache '+self.path+'. Starting a new one.')
+		return {}
+
+	@staticmethod
+	def region(m1, m2):
+		'Name of the mass region of m1, m2 (four bins per doubling of each mass).'
+		return str(int(np.floor(4*np.log2(m1))))+'_'+str(int(np.floor(4*np.log2(m2))))
+
+	def order(self, m1, m2, list_of_apx):
+		'Keep the first approximant (the default) first; sort the fallbacks to try the ones that worked in this region first and skip the ones that only failed there.'
+		# The default is always tried first, so the waveform family of a template never depends on the history of the cache or on timing.
+		default, fallbacks = list_of_apx[0], list_of_apx[1:]
+		region = self.records.get(self.region(m1, m2), {})
+		worked = [apx for apx in fallbacks if apx in region and region[apx][0] > 0]
+		worked.sort(key=lambda apx: region[apx][2]/(region[apx][0]+region[apx][1]))  # fastest first
+		now = time.time()
+		untried = [apx for apx in fallbacks if not apx in region or (region[apx][0] == 0 and now-self.last_failure(region[apx]) > APX_CACHE_EXPIRY)]
+		return [default]+worked+untried
+
+	@staticmethod
+	def last_failure(entry):
+		return entry[3] if len(entry) > 3 else 0.  # files of older versions did not save it; then the failures are expired
+
+	def attempt(self, apx):
+		'Announce trying apx to the parent process, if there is one.'
+		if self.connection is not None:
+			self.connection.send(('try', apx))
+
+	def record(self, m1, m2, apx, success, duration):
+		new_record = (self.region(m1, m2), apx, success, duration, time.time())
+		self._add(self.records, new_record)
+		self.new_records.append(new_record)
+
+	def merge(self, new_records):
+		'Add records from another ApproximantCache (e.g. from a child process).'
+		for new_record in new_records:
+			self._add(self.records, new_record)
+			self.new_records.append(tuple(new_record))
+
+	@staticmethod
+	def _add(records, new_record):
+		region, apx, success, duration, when = new_record
+		entry = records.setdefault(region, {}).setdefault(apx, [0, 0, 0., 0.])
+		if len(entry) < 4:
+			entry.append(0.)
+		entry[0 if success else 1] += 1
+		entry[2] += duration
+		if not success:
+			entry[3] = max(entry[3], when)
+
+	def save(self):
+		'Add the new records to the file (which might have changed in the meantime).'
+		if not self.path or not self.new_records:
+			return
+		records = self.load()
+		for new_record in self.new_records:
+			self._add(records, new_record)
+		try:
+			with open(self.path+'.tmp', 'w') as f:
+				json.dump(records, f)
+			os.replace(self.path+'.tmp', self.path)
+		except OSError as err:   # e.g. a template bank mounted read-only into the container
+			print('Could not save the approximant cache '+self.path+': '+repr(err))
+		self.records = records
+		self.new_records = []
+
+
+def make_template_any_apx( m1, m2, srate=4096, duration=1.0, flag_show=False, errorname='nameless_template', savepath='', apx_cache=None ):
+	'Create a template. Try all allowed approximants (apx), if default apx fails.'
+	# With an ApproximantCache as apx_cache, the default approximant is always tried first; of the others, the ones known to work for similar masses are tried first and the ones known to fail are skipped.
+	if apx_cache is None:
+		apx_cache = ApproximantCache()
+	list_of_apx = [APX_DEFAULT]+[apx for apx in APX_ALLOWED if apx != APX_DEFAULT]
+	for apx in apx_cache.order(m1, m2, list_of_apx):
+		apx_cache.attempt(apx)
+		start = time.time()
+		try:
+			hp_freq, hp = make_template(m1,m2,apx=apx, srate=srate, duration=duration, flag_show=flag_show)
+			if np.isnan(hp_freq[0]) or np.isnan(hp[0]):
+				raise NaNError
+			apx_cache.record(m1, m2, apx, True, time.time()-start)
+			if apx != APX_DEFAULT:
 				print('Creating template with other approximant ('+apx+') worked.')
-				return hp_freq, hp
-			except NaNError:
-				pass              # Custom Error only caused by Frequency-/or TimeSeries starting with a nan. Continue trying the other approximants.
-			except RuntimeError:
-				pass              # Probalby the approximant could not handle this particular set of parameters. Just continue trying the other approximants.
+			return hp_freq, hp
+		except Exception as err:
+			if isinstance(err, (NaNError, RuntimeError)):
+				apx_cache.record(m1, m2, apx, False, time.time()-start)
+			if apx == APX_DEFAULT:
+				print('Creating template with default approximant ('+APX_DEFAULT+') failed. Trying other ones.')
+			elif not isinstance(err, (NaNError, RuntimeError)):
+				raise
+			# NaNError: Custom Error only caused by Frequency-/or TimeSeries starting with a nan. Continue trying the other approximants.
+			# RuntimeError: Probalby the approximant could not handle this particular set of parameters. Just continue trying the other approximants.
 	errorstring = errorname+' ('+str(datetime.now())+'): None of the approximants was able to create a template with masses '+str(m1)+' and '+str(m2)+'.\n'
+	log_error(savepath, errorstring)
+
+
+def log_error(savepath, errorstring):
+	'Print errorstring and append it to the errors.txt in savepath.'
 	print(errorstring)
 	with open(savepath+'errors.txt', 'a') as errorfile:
 		errorfile.write(errorstring)
 
 
+def compute_filter_metadata(freq_series):
+	'Compute what the matched filtering needs to know about a template besides its data: merger offset, sigmasq and nonzero frequency band.'
+	N = 2*(len(freq_series)-1)
+	nonzero = np.flatnonzero(freq_series.numpy())
+	metadata = {}
+	metadata['offset'] = end_time_seconds(freq_series.to_timeseries()) 	# offset of template end_time vs merger-time; in template t=0 is at merger.
+	metadata['sigmasq'] = float(sigmasq(freq_series))
+	metadata['kmin'] = int(max(nonzero[0], 1)) if len(nonzero) else 1                # the band [kmin,kmax) never exceeds the one matched_filter_core() would use.
+	metadata['kmax'] = int(min(nonzero[-1]+1, int((N+1)/2.))) if len(nonzero) else int((N+1)/2.)
+	metadata['content_hash'] = content_hash(freq_series)
+	return metadata
+
+FILTER_METADATA_KEYS = ('offset', 'sigmasq', 'kmin', 'kmax')   # needed by the matched filtering; 'content_hash' is optional (older versions did not save it)
+
+def content_hash(freq_series):
+	'Return the sha1 hash of the content (data and delta_f) of a FrequencySeries.'
+	sha = hashlib.sha1(np.ascontiguousarray(freq_series.numpy()).tobytes())
+	sha.update(repr(float(freq_series.delta_f)).encode())
+	return sha.hexdigest()
+
 def save_FrequencySeries(freq_series, path, m1, m2):
-	'Modified copy of (parts of) pycbcs save() fct. in FrequencySeries to also save the masses.'
+	'Modified copy of (parts of) pycbcs save() fct. in FrequencySeries to also save the masses and the filter metadata.'
 	key = 'data'
+	metadata = compute_filter_metadata(freq_series)
 	with h5py.File(path, 'a') as f:
 		ds = f.create_dataset(key, data=freq_series.numpy(), compression='gzip', compression_opts=9, shuffle=True)
 		if freq_series.epoch is not None:
@@ -266,6 +855,18 @@ def save_FrequencySeries(freq_series, path, m1, m2):
 		ds.attrs['delta_f'] = float(freq_series.delta_f)
 		ds.attrs['m1'] = m1
 		ds.attrs['m2'] = m2
+		for name, value in metadata.items():
+			ds.attrs[name] = value
+
+def save_filter_metadata(path, metadata):
+	'Add the filter metadata to a template file created by an older version of this software (if the file is writable).'
+	key = 'data'
+	try:
+		with h5py.File(path, 'a') as f:
+			for name, value in metadata.items():
+				f[key].attrs[name] = value
+	except OSError:
+		if debugmode: print('Could not save the filter metadata to ',path,' (file is not writable). Moving on.')
 
 
 
@@ -286,9 +887,126 @@ def load_FrequencySeries(path):
 			print('File ',path,' does not have masses m1, m2 as attributes; seems not to be created by the latest version of this software.')
 	return series, m1, m2
 
-
-
-def create_templates(parameters, savepath, basename, attribute, freq_domain, time_domain):
+def load_FrequencySeries_metadata(path):
+	'Load only the masses m1, m2 and the filter metadata saved with a FrequencySeries (without reading the data itself).'
+	key = 'data'
+	m1 = 0.
+	m2 = 0.
+	metadata = None  # older files have no filter metadata
+	with h5py.File(path, 'r') as f:
+		attrs = f[key].attrs
+		try:
+			m1 = attrs['m1']
+			m2 = attrs['m2']
+		except KeyError:
+			print('File ',path,' does not have masses m1, m2 as attributes; seems not to be created by the latest version of this software.')
+		if all(name in attrs for name in FILTER_METADATA_KEYS):
+			metadata = {name: attrs[name].item() for name in FILTER_METADATA_KEYS}
+			if 'content_hash' in attrs: metadata['content_hash'] = str(attrs['content_hash'])
+	return m1, m2, metadata
+
+
+
+### Packed template banks
+#   ----------------------
+
+# A packed template bank is a single .bank.npy file holding all templates (in frequency domain) of a bank, one template per row.
+# Every row is a numpy structured array with the fields name, m1, m2, delta_f, epoch, the filter metadata and data (the complex FrequencySeries).
+# Opening such a bank is a single memory-mapping of the file instead of thousands of h5py.File opens and reading a template only touches its own row.
+# It can be read with numpy alone, so the templatebank handlers on the host can read it without h5py.
+
+PACKED_EXTENSION = '.bank.npy'
+
+_packed_banks = {}  # memory-mapped packed banks, so every file is only opened once
+
+def packed_bank_dtype(length, namelength=64):
+	'Dtype of a row in a packed template bank holding FrequencySeries of the given length (and names up to namelength characters).'
+	return np.dtype([('name', np.str_, namelength), ('m1', np.float64), ('m2', np.float64), ('delta_f', np.float64), ('epoch', np.float64),
+		('offset', np.float64), ('sigmasq', np.float64), ('kmin', np.int64), ('kmax', np.int64), ('content_hash', np.str_, 40), ('data', np.complex128, (length,))])
+
+def load_packed_bank(path):
+	'Memory-map a packed template bank (read-only).'
+	if not path in _packed_banks:
+		_packed_banks[path] = np.load(path, mmap_mode='r')
+	return _packed_banks[path]
+
+def load_FrequencySeries_packed(path, row):
+	'Load a single template from a packed template bank. Analogous to load_FrequencySeries, but also returns the name.'
+	entry = load_packed_bank(path)[row]
+	epoch = entry['epoch'] if not np.isnan(entry['epoch']) else None
+	series = types.frequencyseries.FrequencySeries(np.array(entry['data']), delta_f=float(entry['delta_f']), epoch=epoch)
+	return series, float(entry['m1']), float(entry['m2']), str(entry['name'])
+
+def load_packed_metadata(path, row):
+	'Load only the masses, the name and the filter metadata of a single template from a packed template bank.'
+	bank = load_packed_bank(path)
+	metadata = None
+	if all(name in bank.dtype.names for name in FILTER_METADATA_KEYS):
+		metadata = {name: bank[name][row].item() for name in FILTER_METADATA_KEYS}
+		if 'content_hash' in bank.dtype.names: metadata['content_hash'] = str(bank['content_hash'][row])
+	return float(bank['m1'][row]), float(bank['m2'][row]), str(bank['name'][row]), metadata
+
+class PackedBankWriter:
+	'Write FrequencySeries into a new packed template bank, every template into the row of its index in the bank (in any order).'
+	def __init__(self, path, names):
+		self.path = path
+		self.num = len(names)   # maximum number of templates
+		self.namelength = max([64]+[len(name) for name in names])   # so no name is cut (compare name_dtype)
+		self.used = np.zeros(self.num, dtype=bool)
+		self.bank = None        # the file is created with the first template, when the length of the templates is known
+
+	def add(self, index, name, freq_series, m1, m2):
+		if self.bank is None:
+			self.bank = np.lib.format.open_memmap(self.path, mode='w+', dtype=packed_bank_dtype(len(freq_series), self.namelength), shape=(self.num,))
+		epoch = float(freq_series.epoch) if freq_series.epoch is not None else np.nan
+		metadata = compute_filter_metadata(freq_series)
+		if len(name) > self.namelength:
+			raise ValueError('The name '+name+' is longer than the names this packed template bank was created for.')
+		self.bank[index] = (name, m1, m2, float(freq_series.delta_f), epoch,
+			metadata['offset'], metadata['sigmasq'], metadata['kmin'], metadata['kmax'], metadata['content_hash'], freq_series.numpy())
+		self.used[index] = True
+
+	def close(self):
+		'Flush the bank to disc and cut out unused rows (omitted or failed templates), keeping the order of the others.'
+		if self.bank is None:
+			return
+		self.bank.flush()
+		used = np.flatnonzero(self.used)
+		shorten = len(used) < self.num
+		if shorten:
+			shortened = np.lib.format.open_memmap(self.path+'.tmp', mode='w+', dtype=self.bank.dtype, shape=(len(used),))
+			for start in range(0, len(used), 256):  # copy in chunks to keep memory bounded
+				end = min(start+256, len(used))
+				shortened[start:end] = self.bank[used[start:end]]
+			shortened.flush()
+			del shortened
+		self.bank = None        # closes the memory-map
+		if shorten:
+			os.replace(self.path+'.tmp', self.path)
+		_packed_banks.pop(self.path, None)
+
+def unique_packed_path(savepath, name):
+	'Return a path for a new packed template bank, that does not overwrite an existing one.'
+	path = savepath+name+PACKED_EXTENSION
+	number = 2
+	while os.path.isfile(path):
+		path = savepath+name+'_'+str(number)+PACKED_EXTENSION
+		number += 1
+	return path
+
+def pack_templates(bankpath, filename, list_of_filenames=None):
+	'Pack .hdf templates from bankpath (all, if list_of_filenames is None) into a single packed template bank bankpath+filename.'
+	if list_of_filenames is None:
+		list_of_filenames = [f for f in os.listdir(bankpath) if f.endswith('.hdf')]
+		list_of_filenames.sort()
+	writer = PackedBankWriter(bankpath+filename, [name[:-4] for name in list_of_filenames])
+	for index,name in enumerate(list_of_filenames):
+		freq_series, m1, m2 = load_FrequencySeries(bankpath+name)
+		writer.add(index, name[:-4], freq_series, m1, m2)
+	writer.close()
+
+
+def create_templates(parameters, savepath, basename, attribute, freq_domain, time_domain, packed=False, progress_callback=None):
 	'Creates templates for further use in matched filtering (freq_domain) or as signals (time_domain).'
 
 	# I could add instance checks, dimensions checks or value checks:
@@ -297,7 +1015,7 @@ def create_templates(parameters, savepath, basename, attribute, freq_domain, tim
 
 	# transform parameters to m1,m2, if necessary
 	N = len(parameters[0])
-	np.savetxt(savepath+'00_progress_create.dat', [0, N+1], fmt=['%i'])
+	progress = Progress(savepath, '00_progress_create.dat', N+1, progress_callback)
 	masses = parameters
 	parameter_name = 'mm'
 	if attribute == 'individual':
@@ -352,35 +1070,181 @@ def create_templates(parameters, savepath, basename, attribute, freq_domain, tim
 					list_of_real_duplicates.append(name_index)
 
 	# create templates
-	for index,m1 in enumerate(masses[0]):
-		if not os.path.isfile(savepath+'canceled.txt'):
-			if not index in list_of_real_duplicates:
-				np.savetxt(savepath+'00_progress_create.dat', [index+1, N+1], fmt=['%i'])
-				m2 = masses[1][index]
-				name = list_of_names[index]
-				if 0.49<m1+m2<100.1 : # 0.49<m1<100.1 and 0.49<m2<100.1: <- this is what I wanted at first, but for some reason, runtime explodes with this.
-					try:
-						strain_freq, strain_time = make_template_any_apx(m1,m2, errorname=name)
-						if time_domain: strain_time.save_to_wav(savepath+name+'.wav')
-						if freq_domain: save_FrequencySeries(strain_freq, savepath+name+'.hdf', m1, m2)
-					except ValueError:
-						errorstring = name+' ('+str(datetime.now())+'): There was a ValueError; probably a .hdf-file of that name already existed.\n'
-						print(errorstring)
-						with open(savepath+'errors.txt', 'a') as errorfile:
-							errorfile.write(errorstring)
-					except:
-						errorstring = name+' ('+str(datetime.now())+'): Unexpected Error with masses '+str(m1)+', '+str(m2)+'.\n'
-						print(errorstring)
-						with open(savepath+'errors.txt', 'a') as errorfile:
-							errorfile.write(errorstring)
-				else:
-					if debugmode: 
-						print('create_templates: omitting masses '+str(m1)+', '+str(m2)+' (out of range)')
-		else:
+	apx_cache = ApproximantCache(savepath+APX_CACHE_FILENAME)
+	writer = None
+	if freq_domain and packed:
+		writer = PackedBankWriter(unique_packed_path(savepath, basename+parameter_name), list_of_names)
+	if ISOLATED_CREATION:
+		jobs = []
+		for index,m1 in enumerate(masses[0]):
+			m2 = masses[1][index]
+			if not index in list_of_real_duplicates and 0.49<m1+m2<100.1:
+				jobs.append((index, list_of_names[index], m1, m2))
+			elif debugmode and not index in list_of_real_duplicates:
+				print('create_templates: omitting masses '+str(m1)+', '+str(m2)+' (out of range)')
+		create_templates_isolated(jobs, savepath, freq_domain, time_domain, writer, N, apx_cache, progress)
+	else:
+		for index,m1 in enumerate(masses[0]):
+			if not progress.update(index+1):
+				if not index in list_of_real_duplicates:
+					m2 = masses[1][index]
+					name = list_of_names[index]
+					if 0.49<m1+m2<100.1 : # 0.49<m1<100.1 and 0.49<m2<100.1: <- this is what I wanted at first, but for some reason, runtime explodes with this.
+						try:
+							strain_freq, strain_time = make_template_any_apx(m1,m2, errorname=name, savepath=savepath, apx_cache=apx_cache)
+							if time_domain: strain_time.save_to_wav(savepath+name+'.wav')
+							if freq_domain and packed: writer.add(index, name, strain_freq, m1, m2)
+							elif freq_domain: save_FrequencySeries(strain_freq, savepath+name+'.hdf', m1, m2)
+						except ValueError:
+							log_error(savepath, name+' ('+str(datetime.now())+'): There was a ValueError; probably a .hdf-file of that name already existed.\n')
+						except:
+							log_error(savepath, name+' ('+str(datetime.now())+'): Unexpected Error with masses '+str(m1)+', '+str(m2)+'.\n')
+					else:
+						if debugmode: 
+							print('create_templates: omitting masses '+str(m1)+', '+str(m2)+' (out of range)')
+			else:
+				print('Template creation canceled by user.')
+				progress.reset_cancel()
+				break
+	if freq_domain and packed:
+		writer.close()
+	apx_cache.save()
+	# progress.update(N+1)
+
+
+def _create_template_child(connection, m1, m2, name, savepath, apx_cache):
+	'Create a single template inside a child process and send it (and the new approximant records) to the parent process.'
+	apx_cache.new_records = []
+	apx_cache.connection = connection
+	try:
+		connection.send(('ok', make_template_any_apx(m1, m2, errorname=name, savepath=savepath, apx_cache=apx_cache), apx_cache.new_records))
+	except Exception as err:
+		connection.send(('error', repr(err), apx_cache.new_records))
+	connection.close()
+
+def create_templates_isolated(jobs, savepath, freq_domain, time_domain, writer, N, apx_cache, progress):
+	'Create templates for a list of jobs (index, name, m1, m2), each in its own child process with a timeout. Used by create_templates.'
+	jobs = jobs[::-1]  # so jobs.pop() keeps the order
+	running = []
+	done = N-len(jobs)  # for the progress bar, omitted masses count as done
+	while jobs or running:
+		if progress.update(done):
+			for process, _, _, _, _, _, _, _ in running:
+				process.kill()
+				process.join()
 			print('Template creation canceled by user.')
-			os.remove(savepath+'canceled.txt')
+			progress.reset_cancel()
 			break
-	# np.savetxt(savepath+'00_progress_create.dat', [N+1, N+1], fmt=['%i'])
+		# start new child processes
+		while jobs and len(running) < WORKERS:
+			index, name, m1, m2 = jobs.pop()
+			receiver, sender = multiprocessing.Pipe(duplex=False)
+			process = multiprocessing.Process(target=_create_template_child, args=(sender, m1, m2, name, savepath, apx_cache), daemon=True)
+			process.start()
+			sender.close()  # only the child keeps the sending end open, so a crashing child shows up as EOFError on the receiving end
+			running.append([process, receiver, index, name, m1, m2, time.time(), None])  # the last entry is the current attempt (apx, start)
+		# collect finished, crashed or timed out child processes
+		multiprocessing.connection.wait([entry[1] for entry in running], timeout=0.5)
+		for entry in list(running):
+			process, receiver, index, name, m1, m2, start, _ = entry
+			status = None
+			try:
+				while status is None and receiver.poll():
+					message = receiver.recv()
+					if message[0] == 'try':
+						entry[7] = (message[1], time.time())
+					else:
+						status, result, new_records = message
+						apx_cache.merge(new_records)
+			except EOFError:
+				status, result = 'crashed', None
+			if status is None and time.time()-start > TEMPLATE_TIMEOUT:
+				process.kill()
+				status, result = 'timeout', None
+			if status is None:
+				continue
+			if status == 'crashed' and entry[7] is not None:
+				apx_cache.record(m1, m2, entry[7][0], False, time.time()-entry[7][1])  # so this approximant is skipped for similar masses next time (a timeout might just be a busy machine)
+			process.join()
+			receiver.close()
+			running.remove(entry)
+			done += 1
+			if status == 'crashed':
+				log_error(savepath, name+' ('+str(datetime.now())+'): Creating the template with masses '+str(m1)+', '+str(m2)+' crashed (exit code '+str(process.exitcode)+').\n')
+			elif status == 'timeout':
+				log_error(savepath, name+' ('+str(datetime.now())+'): Creating the template with masses '+str(m1)+', '+str(m2)+' took longer than '+str(TEMPLATE_TIMEOUT)+' s and was stopped.\n')
+			elif status == 'error':
+				log_error(savepath, name+' ('+str(datetime.now())+'): Unexpected Error with masses '+str(m1)+', '+str(m2)+': '+result+'\n')
+			elif result is not None:  # if None, make_template_any_apx already wrote the error
+				strain_freq, strain_time = result
+				try:
+					if time_domain: strain_time.save_to_wav(savepath+name+'.wav')
+					if writer is not None: writer.add(index, name, strain_freq, m1, m2)
+					elif freq_domain: save_FrequencySeries(strain_freq, savepath+name+'.hdf', m1, m2)
+				except ValueError:
+					log_error(savepath, name+' ('+str(datetime.now())+'): There was a ValueError; probably a .hdf-file of that name already existed.\n')
+
+
+def stack_spectra(segments, dtype=np.float64, blocksize=256):
+	'Return the spectra of a list of equally long TimeSeries as one contiguous 2D array (one segment per row).'
+	# with dtype float32, the spectra are complex64 (numpy >= 2 keeps the precision in np.fft; older versions compute in double anyway)
+	# The segments are transformed blockwise, so besides the segments and the spectra, only one block of blocksize segments is copied.
+	segment_spectra = None
+	for start in range(0, len(segments), blocksize):
+		block = np.array([np.asarray(segment) for segment in segments[start:start+blocksize]], dtype=dtype)
+		spectra = segments[0].delta_t*np.fft.rfft(block, axis=1)  # same as TimeSeries.to_frequencyseries() for every segment
+		if segment_spectra is None:
+			segment_spectra = np.empty((len(segments), spectra.shape[1]), dtype=spectra.dtype)
+		segment_spectra[start:start+len(block)] = spectra
+	return segment_spectra
+
+
+def sigmasq_segments(segment_spectra, delta_f):
+	'Return sigmasq() of every segment (row) in segment_spectra.'
+	N = 2*(segment_spectra.shape[1]-1)
+	kmin, kmax = 1, int((N+1)/2.)  # as get_cutoff_indices() without cutoffs
+	spectra = segment_spectra[:,kmin:kmax]
+	return 4.0*delta_f*(np.einsum('ij,ij->i', spectra.real, spectra.real, dtype=np.float64) + np.einsum('ij,ij->i', spectra.imag, spectra.imag, dtype=np.float64))   # summed up in double precision also for single precision spectra
+
+
+def batched_matched_filter(segment_spectra, segment_norms, delta_f, htilde, htilde_delta_f, h_norm=None, kmin=None, kmax=None, blocksize=256, keep_snr=False):
+	'Correlate a template with all data segments at once. A vectorized version of pycbcs matched_filter_core() and sigmasq() without psd and frequency cutoffs.'
+
+	# segment_spectra is a 2D array of one-sided spectra (one segment per row), segment_norms their sigmasq(), htilde a one-sided spectrum of the same length.
+	# h_norm (sigmasq of the template) and the band [kmin,kmax) outside of which htilde is zero can be passed, if they are known already.
+	# Segments are processed in blocks of blocksize rows, to keep the temporary complex arrays small for long recordings.
+	num, lenspec = segment_spectra.shape
+	if len(htilde) != lenspec:
+		raise ValueError('Length of template and data segments must match, but got '+str(len(htilde))+' and '+str(lenspec))
+	N = 2*(lenspec-1)
+	if kmin is None: kmin = 1                 # as get_cutoff_indices() without cutoffs
+	if kmax is None: kmax = int((N+1)/2.)
+	hconj = np.conj(np.asarray(htilde)[kmin:kmax]).astype(segment_spectra.dtype, copy=False)   # in the precision of the data
+	if h_norm is None:
+		h_norm = 4.0*htilde_delta_f*np.vdot(hconj, hconj).real                                     # sigmasq(template)
+	norm = 4.0*delta_f/np.sqrt(h_norm)
+
+	### initialize outputs
+	matches = np.zeros(num)
+	indices = np.zeros(num)
+	phis = np.zeros(num)
+	mf_out = np.zeros((num, N), dtype=segment_spectra.dtype) if keep_snr else None
+	qtilde = np.zeros((min(blocksize, num), N), dtype=segment_spectra.dtype)  # only [kmin:kmax] gets filled, the rest stays zero
+
+	### correlate block after block
+	for start in range(0, num, blocksize):
+		end = min(start+blocksize, num)
+		block = qtilde[:end-start]
+		np.multiply(hconj, segment_spectra[start:end,kmin:kmax], out=block[:,kmin:kmax])
+		snr = N*np.fft.ifft(block, axis=1)                  # pycbcs ifft is not normalized, numpys is.
+		index1 = np.argmax(np.abs(snr), axis=1)
+		maxsnr = np.abs(snr[np.arange(end-start), index1])*norm
+		matches[start:end] = maxsnr/np.sqrt(segment_norms[start:end])
+		indices[start:end] = index1
+		phis[start:end] = np.angle(snr[np.arange(end-start), index1])
+		if keep_snr: mf_out[start:end] = snr*norm
+
+	return matches, indices, phis, mf_out
 
 
 def matched_filter_single(data, template):
@@ -388,69 +1252,36 @@ def matched_filter_single(data, template):
 
 	plot_snr = False
 
-	tmp = template.frequency_series 							# readability
-	offset = get_end_time(tmp.to_timeseries()).total_seconds() 	# offset of template end_time vs merger-time; in template t=0 is at merger.
+	tmp = template.spectrum(data.precision) 					# readability; FrequencySeries in double, numpy array in single precision
+	metadata = template.filter_metadata()
+	offset = metadata['offset']                                 # offset of template end_time vs merger-time; in template t=0 is at merger.
 
-	### initialize outputs
+	### matched filtering for all segments at once
 	num = len(data.segments)
 	lenseg = len(data.segments[0])
-	deltat = data.segments[0].delta_t
-	matches = np.zeros(num)
-	indices = np.zeros(num)
-	times = np.zeros(num)
-	phis = np.zeros(num)
-	count_of_max = 0
-	detail_match = 0.
+	deltat = data.delta_t
+	matches, indices, phis, mf_out = batched_matched_filter(data.segment_spectra, data.segment_norms, data.delta_f, tmp, data.delta_f,   # same delta_f as the template, since the lengths match
+		h_norm=metadata['sigmasq'], kmin=metadata['kmin'], kmax=metadata['kmax'], keep_snr=plot_snr)
+	times = data.start_times + indices*deltat - offset
+	count_of_max = int(np.argmax(matches))
+
+	### plot results
 	if plot_snr:
 		# snr over whole data length ('full')
 		lensnr = int(0.5*(num+1)*lenseg)
 		snr_even = np.zeros(lensnr, dtype=np.complex128)
 		snr_odd = np.zeros(lensnr, dtype=np.complex128)
 		full_time = np.arange(lensnr)*deltat
-		# snr around merger ('detail')
-		detail_snr = np.zeros(lenseg, dtype=np.complex128)
-		detail_time = np.zeros(lenseg)
-
-
-	### matched filtering for all segments
-	for count,segment in enumerate(data.segments):
-
-		snr,_,snr_norm = matched_filter_core(tmp, segment) #, psd=psd, low_frequency_cutoff=f_low)
-		# Following 4 lines: the pycbc matched_filter() and match() functions. Calling those two would calculate matched_filter_core() twice. 
-		mf_out = snr*snr_norm                              # mf_out = matched_filter(...)
-		v2_norm = sigmasq(segment)                         # match1,index1,phi1 = match(tmp, segment, return_phase=True)
-		maxsnr, index1 = mf_out.abs_max_loc()
-		match1 = maxsnr/np.sqrt(v2_norm)          # (maxsnr (mf_out) is already normed)
-		if plot_snr:
+		for count in range(num):
 			start = int(0.5*count*lenseg)
 			end = start+lenseg
 			if count % 2 == 0:
-				snr_even[start:end] = mf_out
-			else: snr_odd[start:end] = mf_out
-
-		matches[count] = match1
-		indices[count] = index1
-		end_time = get_end_time(segment)
-		times[count] = end_time.total_seconds() - segment.duration + index1/segment.sample_rate - offset
-		phis[count] = np.angle(snr[int(round(index1))])
-
-		if match1 > detail_match:
-			count_of_max = count
-			detail_match = match1
-			if plot_snr:
-				detail_snr = mf_out
-				detail_time = np.arange(lenseg)*deltat+full_time[start]
-
-		if False:
-			plt.plot(mf_out.sample_times, abs(mf_out))
-			plt.ylabel('signal-to-noise ratio')
-			plt.xlabel('time (s)')
-			plt.title('snr of '+data.shortname+' with '+template.shortname+' - '+str(count).zfill(2))
-			plt.savefig(data.savepath+'SNR_'+data.shortname+'_'+template.shortname+'_'+str(count).zfill(2)+'.png')
-			if data.flag_show: plt.show()
-			else: plt.close()  
-	
-	### plot results		
+				snr_even[start:end] = mf_out[count]
+			else: snr_odd[start:end] = mf_out[count]
+		# snr around merger ('detail')
+		detail_snr = mf_out[count_of_max]
+		detail_time = np.arange(lenseg)*deltat+full_time[int(0.5*count_of_max*lenseg)]
+
 	# create and plot full snr
 	if plot_snr:
 		full_snr = np.maximum(snr_even, snr_odd)
@@ -478,87 +1309,954 @@ def matched_filter_single(data, template):
 	# plot template and data together
 	# Plotting template and data together ('merger plot') is now done by calling the plot_merger function. (since v0.2)
 	# Actually calling plot_merger is swapped out to the matched_filter_templatebank function, to save disc space by calling it only for the best matching templates.
-	# In case all merger plots should be created, it is still executed here, to keep progress bar more meaningful.
+	# In case all merger plots should be created, it is still executed here (the rendering happens in the background anyway).
 	if config.getboolean('mergerplots', 'create_all'): plot_merger(data, template, Maxmatch)
 
 	return matches, indices, times, phis, Maxmatch
 
 
-def plot_merger(data, template, Maxmatch):
-	'Plot data and template together at the time of best match.'
+def _init_worker(data, templatebank):
+	'Make data and templatebank available in a worker process.'
+	global _worker_data, _worker_templatebank
+	_worker_data = data
+	_worker_templatebank = templatebank
 
-	# Maybe add insance checks for data and template objects.
+def _matched_filter_worker(index, keep_segments=False):
+	'Matched filtering with a single template of the templatebank inside a worker process.'
+	matches, indices, _, phis, Maxmatch = matched_filter_single(_worker_data, _worker_templatebank.list_of_templates[index])
+	if keep_segments:
+		return Maxmatch, (matches, indices, phis)
+	return Maxmatch
 
-	tmp = template.frequency_series		# readability
+def iterate_templatebank(data, templatebank, workers=1, keep_segments=False):
+	'Yield the Maxmatch of every template in the templatebank in bank order. Uses a pool of worker processes, if workers > 1.'
+	# With keep_segments, (Maxmatch, (matches, indices, phis)) is yielded instead, with the results of every segment.
+	num = len(templatebank.list_of_templates)
+	if workers < 2 or num < 2:
+		for template in templatebank.list_of_templates:
+			matches, indices, _, phis, Maxmatch = matched_filter_single(data, template)
+			yield (Maxmatch, (matches, indices, phis)) if keep_segments else Maxmatch
+	else:
+		# Leaving the with-block (also when the generator is closed early, e.g. on cancel) terminates the workers.
+		with multiprocessing.Pool(min(workers, num), initializer=_init_worker, initargs=(data, templatebank)) as pool:
+			for result in pool.imap(functools.partial(_matched_filter_worker, keep_segments=keep_segments), range(num)):
+				yield result
 
-	# settings for plot
-	before = config.getfloat('mergerplots', 'time_before_merger')   # start plot *before* merger (in s)
-	after = config.getfloat('mergerplots', 'time_before_merger')    # end        * after* merger (in s)
-	# create arrays for plot 
-	plot_data = data.segments[Maxmatch[3]]/np.sqrt(sigmasq(data.segments[Maxmatch[3]]))   # normed data segment.
-	plot_time = plot_data.sample_times
-	tmp_shift = np.exp(1j*Maxmatch[2])*tmp
-	tmp_time = tmp_shift.to_timeseries()
-	tmp_time = Maxmatch[0]/np.sqrt(sigmasq(tmp_time))*tmp_time
-	index1 = int(Maxmatch[4])
-	lenseg = len(data.segments[0])
-	plot_tmp = np.concatenate( (np.asarray(tmp_time[(lenseg-index1):]), np.zeros(lenseg-index1)) )
-	# plot
-	offset = get_end_time(tmp.to_timeseries()).total_seconds() 	# offset of template end_time vs merger-time; in template t=0 is at merger.
-	offset_ind = int(round(offset*plot_data.sample_rate))
-	start = max( int(round(index1-before*plot_data.sample_rate))-offset_ind, 0)
-	end = min( int(round(index1+after*plot_data.sample_rate))-offset_ind, lenseg)
-	plt.plot(plot_time[start:end], plot_data[start:end], color='tab:blue', linestyle='-', marker=',')
-	plt.plot(plot_time[start:end], plot_tmp[start:end], color='tab:red', linestyle=':', marker=',', linewidth=2., alpha=1.0) 
-	plt.legend(['data', 'template'])
-	plt.xlabel('time (s)')
-	plt.ylabel('amplitude (a.u.)')
-	plt.title(data.shortname+' and '+template.shortname+'; t = '+str(round(Maxmatch[1],3))+' s, match = '+str(round(Maxmatch[0],2)))
-	plt.savefig(data.savepath+'plot_'+data.shortname+'_'+template.shortname+'.png')
-	if data.flag_show: plt.show()
-	plt.close() 
-
-
-def matched_filter_templatebank(data, templatebank):
+
+def name_dtype(names):
+	'Fixed-width str dtype long enough for all names (but at least 40 characters, as in the result files of older versions).'
+	return (np.str_, max([40]+[len(name) for name in names]))
+
+def matched_filter_templatebank(data, templatebank, workers=WORKERS, progress_callback=None):
 	'Perform the matched filtering of the data with every template inside a templatebank.'
 	# prepare output
 	num = len(templatebank.list_of_templates)
-	np.savetxt(data.savepath+'00_progress_mf.dat', [0, num+2], fmt=['%i'])
-	dtype = [('templatename', (np.str_,40)), ('maxmatch', np.float64), ('maxtime', np.float64), ('m1', np.float64), ('m2', np.float64), ('M', np.float64), ('r', np.float64), ('Mc', np.float64)]
+	progress = Progress(data.savepath, '00_progress_mf.dat', num+2, progress_callback)
+	dtype = [('templatename', name_dtype([template.shortname for template in templatebank.list_of_templates])), ('maxmatch', np.float64), ('maxtime', np.float64), ('m1', np.float64), ('m2', np.float64), ('M', np.float64), ('r', np.float64), ('Mc', np.float64)]
 	results = np.zeros((num,8))
 	names = []
 	maxmatches_all = []
+	maxmatch_details = np.zeros((num,5))   # the whole Maxmatch of every template, for regenerate_merger_plots
 	writedata = np.array(np.zeros(num), dtype=dtype)
 	sortdata = np.array(np.zeros(num), dtype=dtype)
-	# calculate output
+	# calculate output (templates already filtered with this data in earlier runs are taken from the filter cache)
+	store = SegmentStoreWriter(data.savepath+SEGMENT_STORE_FILENAME, data, templatebank) if SEGMENT_STORE and num else None
+	if FILTER_CACHE:
+		filter_cache = FilterCache(data.savepath+FILTER_CACHE_DIR+filter_cache_key(data)+'.hdf', len(data.segments))
+		maxmatches = iterate_templatebank_cached(data, templatebank, filter_cache, workers)
+	else:
+		maxmatches = iterate_templatebank(data, templatebank, workers, keep_segments=store is not None)
+	canceled = False
 	for index,template in enumerate(templatebank.list_of_templates):
-		if not os.path.isfile(data.savepath+'canceled.txt'):
-			np.savetxt(data.savepath+'00_progress_mf.dat', [index+1, num+2], fmt=['%i'])
-			_,_,_,_,Maxmatch = matched_filter_single(data, template)
+		if not progress.update(index+1):
+			Maxmatch = next(maxmatches)
+			if FILTER_CACHE or store is not None:
+				Maxmatch, segment_results = Maxmatch
+				if store is not None: store.add(*segment_results)
 			maxmatches_all.append(Maxmatch)
+			maxmatch_details[index] = [float(value) for value in Maxmatch]
 			results[index] = index, Maxmatch[0], Maxmatch[1], template.m1, template.m2, template.m1+template.m2, template.m2/template.m1, np.power(template.m1*template.m2, 0.6)/np.power(template.m1+template.m2, 0.2)
 			names.append(template.shortname)
 			writedata[index] = template.shortname, Maxmatch[0], Maxmatch[1], template.m1, template.m2, template.m1+template.m2, template.m2/template.m1, np.power(template.m1*template.m2, 0.6)/np.power(template.m1+template.m2, 0.2)
 		else:
 			print('Matched filtering canceled by user.')
+			canceled = True
 			break
-	np.savetxt(data.savepath+'00_progress_mf.dat', [num+1, num+2], fmt=['%i'])
+	maxmatches.close()  # stops the worker processes, if there are any left
+	if store is not None: store.close(complete=not canceled)
+	progress.update(num+1, force=True)
 	# sorted output
 	results_sorted = results[results[:,1].argsort()[::-1]]
 	for index in range(num):
 		sortdata[index] = names[int(results_sorted[index,0])], results_sorted[index,1], results_sorted[index,2], results_sorted[index,3], results_sorted[index,4], results_sorted[index,5], results_sorted[index,6], results_sorted[index,7]
-		# create a merger plot for best matching templates
-		if not config.getboolean('mergerplots', 'create_all'):
-			if index < config.getint('mergerplots', 'min_number'):  # I refrain from updating the progress bar while plotting even if it takes a noticeable amount of time. 
-				plot_merger(data, templatebank.list_of_templates[int(results_sorted[index,0])], maxmatches_all[int(results_sorted[index,0])])
-			if index < config.getint('mergerplots', 'max_number') and results_sorted[index,1] > config.getfloat('mergerplots', 'match_threshold'):
-				plot_merger(data, templatebank.list_of_templates[int(results_sorted[index,0])], maxmatches_all[int(results_sorted[index,0])])
-	# save results unsorted
-	header = 'Matched Filtering results of '+data.shortname+': \n'
-	header += 'templatename, match, time of match, template-m1, template-m2, template-M, template-R, template-Mc'
-	np.savetxt(data.savepath+'00_matched_filtering_results.dat', writedata, fmt=['%s', '%f', '%f', '%f', '%f', '%f', '%f', '%f'], header=header)
-	# save results sorted by match
-	header = 'Matched Filtering results of '+data.shortname+' (sorted by match): \n'
-	header += 'templatename, match, time of match, template-m1, template-m2, template-M, template-R, template-Mc'
-	np.savetxt(data.savepath+'00_matched_filtering_results_sorted.dat', sortdata, fmt=['%s', '%f', '%f', '%f', '%f', '%f', '%f', '%f'], header=header)
-	np.savetxt(data.savepath+'00_progress_mf.dat', [num+2, num+2], fmt=['%i'])
\ No newline at end of file
+	# create a merger plot for best matching templates (rendered in the background, see Merger plots)
+	if not config.getboolean('mergerplots', 'create_all'):
+		for rank in merger_plot_ranks(results_sorted[:,1]):
+			plot_merger(data, templatebank.list_of_templates[int(results_sorted[rank,0])], maxmatches_all[int(results_sorted[rank,0])])
+	# save results (columns in bank order and the order sorted by match)
+	save_results(data.savepath+RESULTS_FILENAME, writedata, results_sorted[:,0].astype(np.int64), data.shortname, maxmatch_details)
+	if RESULTS_TEXT_EXPORT:
+		# save results unsorted
+		header = 'Matched Filtering results of '+data.shortname+': \n'
+		header += 'templatename, match, time of match, template-m1, template-m2, template-M, template-R, template-Mc'
+		np.savetxt(data.savepath+'00_matched_filtering_results.dat', writedata, fmt=['%s', '%f', '%f', '%f', '%f', '%f', '%f', '%f'], header=header)
+		# save results sorted by match
+		header = 'Matched Filtering results of '+data.shortname+' (sorted by match): \n'
+		header += 'templatename, match, time of match, template-m1, template-m2, template-M, template-R, template-Mc'
+		np.savetxt(data.savepath+'00_matched_filtering_results_sorted.dat', sortdata, fmt=['%s', '%f', '%f', '%f', '%f', '%f', '%f', '%f'], header=header)
+	progress.update(num+2)
+
+
+def save_results(filename, writedata, order, shortname, maxmatch_details=None):
+	'Save the results of a matched filtering (structured array as in matched_filter_templatebank) column by column into a .npz-file.'
+	# Every column is its own array, so e.g. plotting only reads m1, m2 and match. Names are stored in full length. order holds the indices sorted by match.
+	# maxmatch_details holds the whole Maxmatch (match, time, phase, segment, index) of every template.
+	columns = {name: writedata[name] for name in writedata.dtype.names}
+	columns['templatename'] = np.array([str(name) for name in writedata['templatename']])
+	if maxmatch_details is not None: columns['maxmatch_details'] = maxmatch_details
+	np.savez(filename+'.tmp.npz', order=order, dataname=np.array(shortname), **columns)
+	os.replace(filename+'.tmp.npz', filename)
+
+def load_results(filename):
+	'Load the results of a matched filtering from a .npz-file (or an old .dat-file) as a dictionary of columns.'
+	if filename.endswith('.npz'):
+		with np.load(filename) as f:
+			return {name: f[name] for name in f.files}
+	columns = ['templatename', 'maxmatch', 'maxtime', 'm1', 'm2', 'M', 'r', 'Mc']
+	results = np.loadtxt(filename, dtype={'names': columns, 'formats': ['U256']+['f8']*7}, ndmin=1)
+	results = {name: results[name] for name in columns}
+	results['order'] = np.argsort(results['maxmatch'], kind='stable')[::-1]
+	return results
+
+
+### Merger plots
+#   ------------
+
+# Rendering the merger plots often takes longer than the matched filtering itself. So plot_merger only cuts out what is plotted (merger_plot_job)
+# and the plot is rendered by a pool of background processes (with the object oriented Agg API of matplotlib, no pyplot state), while the next
+# template or job is already filtered. Set background_workers = 0 (section mergerplots in config.ini) to render them right away.
+# The Maxmatch of every template is saved with the results, so the merger plots can be made again later without filtering (regenerate_merger_plots).
+
+MERGER_PLOT_WORKERS = config.getint('mergerplots', 'background_workers', fallback=0)
+_merger_plot_pool = None
+
+def merger_plot_job(data, template, Maxmatch):
+	'Everything needed to render the merger plot of data and template at the time of best match (only small arrays, so it can be sent to another process).'
+
+	# Maybe add insance checks for data and template objects.
+
+	tmp = template.frequency_series		# readability
+
+	# settings for plot
+	before = config.getfloat('mergerplots', 'time_before_merger')   # start plot *before* merger (in s)
+	after = config.getfloat('mergerplots', 'time_before_merger')    # end        * after* merger (in s)
+	# create arrays for plot 
+	plot_data = data.segments[Maxmatch[3]]/np.sqrt(data.segment_norms[Maxmatch[3]])   # normed data segment.
+	plot_time = data.start_times[Maxmatch[3]]+np.arange(len(plot_data))*data.delta_t
+	tmp_shift = np.exp(1j*Maxmatch[2])*tmp
+	tmp_time = tmp_shift.to_timeseries()
+	tmp_time = Maxmatch[0]/np.sqrt(template.filter_metadata()['sigmasq'])*tmp_time
+	index1 = int(Maxmatch[4])
+	lenseg = len(data.segments[0])
+	plot_tmp = np.concatenate( (np.asarray(tmp_time[(lenseg-index1):]), np.zeros(lenseg-index1)) )
+	# plot
+	offset = template.filter_metadata()['offset'] 	# offset of template end_time vs merger-time; in template t=0 is at merger.
+	offset_ind = int(round(offset*plot_data.sample_rate))
+	start = max( int(round(index1-before*plot_data.sample_rate))-offset_ind, 0)
+	end = min( int(round(index1+after*plot_data.sample_rate))-offset_ind, lenseg)
+	return {'time': np.asarray(plot_time[start:end]), 'data': np.asarray(plot_data[start:end]), 'template': plot_tmp[start:end],
+		'title': data.shortname+' and '+template.shortname+'; t = '+str(round(Maxmatch[1],3))+' s, match = '+str(round(Maxmatch[0],2)),
+		'filename': data.savepath+'plot_'+data.shortname+'_'+template.shortname+'.png'}
+
+def draw_merger_plot(axes, job):
+	axes.plot(job['time'], job['data'], color='tab:blue', linestyle='-', marker=',')
+	axes.plot(job['time'], job['template'], color='tab:red', linestyle=':', marker=',', linewidth=2., alpha=1.0) 
+	axes.legend(['data', 'template'])
+	axes.set_xlabel('time (s)')
+	axes.set_ylabel('amplitude (a.u.)')
+	axes.set_title(job['title'])
+
+def render_merger_plot(job):
+	'Render and save a merger plot (see merger_plot_job) without pyplot.'
+	figure = Figure()
+	FigureCanvasAgg(figure)
+	draw_merger_plot(figure.add_subplot(), job)
+	figure.savefig(job['filename'])
+
+def _merger_plot_failed(err):
+	print('A merger plot could not be created: '+repr(err))
+
+def plot_merger(data, template, Maxmatch):
+	'Plot data and template together at the time of best match (in the background, if background_workers > 0).'
+	job = merger_plot_job(data, template, Maxmatch)
+	if data.flag_show:
+		draw_merger_plot(plt.gca(), job)
+		plt.savefig(job['filename'])
+		plt.show()
+		plt.close()
+	elif MERGER_PLOT_WORKERS < 1 or multiprocessing.current_process().daemon:   # worker processes of a pool can not start another pool
+		render_merger_plot(job)
+	else:
+		global _merger_plot_pool
+		if _merger_plot_pool is None:
+			_merger_plot_pool = multiprocessing.Pool(MERGER_PLOT_WORKERS)
+		_merger_plot_pool.apply_async(render_merger_plot, (job,), error_callback=_merger_plot_failed)
+
+def wait_merger_plots():
+	'Wait until all merger plots in the background are saved.'
+	global _merger_plot_pool
+	if _merger_plot_pool is not None:
+		_merger_plot_pool.close()
+		_merger_plot_pool.join()
+		_merger_plot_pool = None
+
+atexit.register(wait_merger_plots)   # so a script does not end before its plots are saved
+
+def merger_plot_ranks(sorted_matches):
+	'Ranks (in the results sorted by match) of the templates that get a merger plot, as set in the section mergerplots of config.ini.'
+	ranks = []
+	for index, match in enumerate(sorted_matches):
+		if index < config.getint('mergerplots', 'min_number') or (index < config.getint('mergerplots', 'max_number') and match > config.getfloat('mergerplots', 'match_threshold')):
+			ranks.append(index)
+	return ranks
+
+def regenerate_merger_plots(data, templatebank, names=None):
+	'Create the merger plots of the templates in names (default: as after a matched filtering) again from the saved results, without filtering.'
+	results = load_results(data.savepath+RESULTS_FILENAME)
+	if not 'maxmatch_details' in results:
+		raise ValueError('The results in '+data.savepath+' do not contain the details of the best matches (they are older). Please repeat the matched filtering.')
+	saved_names = [str(name) for name in results['templatename']]
+	if names is None:
+		order = results['order']
+		if config.getboolean('mergerplots', 'create_all'):
+			rows = list(order)
+		else:
+			rows = [order[rank] for rank in merger_plot_ranks(results['maxmatch'][order])]
+	else:
+		rows = [saved_names.index(str(name)) for name in names if str(name) in saved_names]
+		missing = [str(name) for name in names if not str(name) in saved_names]
+		if missing: print('Regenerating merger plots: no saved results for '+', '.join(missing)+'. Skipping them.')
+	# The rows of the results are in the order of the template bank that was filtered, so usually the template is found by its index.
+	templates_by_name = {template.shortname: template for template in templatebank.list_of_templates}
+	missing = []
+	for row in rows:
+		row = int(row)
+		if row < len(templatebank.list_of_templates) and same_templatename(saved_names[row], templatebank.list_of_templates[row].shortname):
+			template = templatebank.list_of_templates[row]
+		else:  # the template bank changed since the matched filtering
+			template = templates_by_name.get(saved_names[row])
+		if template is None:
+			missing.append(saved_names[row])
+			continue
+		Maxmatch = results['maxmatch_details'][row]
+		plot_merger(data, template, [Maxmatch[0], Maxmatch[1], Maxmatch[2], int(Maxmatch[3]), int(Maxmatch[4])])
+	if missing: print('Regenerating merger plots: '+', '.join(missing)+' not found in the template bank. Skipping them.')
+	wait_merger_plots()
+
+def same_templatename(saved_name, shortname):
+	'Whether a name from saved results belongs to the template shortname (results of older versions cut the names to 40 characters).'
+	return saved_name == shortname or (len(saved_name) == 40 and shortname.startswith(saved_name))
+
+
+### Per-segment results store
+#   --------------------------
+
+# Besides the best match of every template, the matched filtering finds the best match of every template in every segment.
+# These (templates x segments) matrices are kept in 00_segment_results.hdf, so later questions (e.g. the second best event, or
+# when a certain template matched) can be answered without a rerun. To keep it compact, match and phase are stored as float32 and
+# the position of the match in its segment as int32. The time follows exactly as segment_start + index*delta_t - offset (of the template).
+# The datasets are chunked in blocks of templates and segments, so reading a time window or a single template only touches few chunks.
+
+class SegmentStoreWriter:
+	'Write the per-segment results of one template after another into a new segment results file.'
+	def __init__(self, path, data, templatebank, blocksize=64):
+		self.path = path
+		self.num = len(templatebank.list_of_templates)
+		self.num_segments = len(data.segments)
+		self.blocksize = blocksize
+		self.count = 0
+		self.buffer = []        # results are written in blocks of blocksize templates
+		chunks = (min(self.num, blocksize), min(self.num_segments, 1024))
+		self.file = h5py.File(path+'.tmp', 'w')
+		self.file.attrs['dataname'] = data.shortname
+		self.file.attrs['delta_t'] = data.delta_t
+		self.file.attrs['segment_duration'] = data.segment_duration
+		self.file.attrs['num_filtered'] = 0
+		self.file.create_dataset('segment_start', data=data.start_times)
+		self.file.create_dataset('templatename', data=[template.shortname for template in templatebank.list_of_templates], dtype=h5py.string_dtype())
+		self.file.create_dataset('m1', data=[template.m1 for template in templatebank.list_of_templates])
+		self.file.create_dataset('m2', data=[template.m2 for template in templatebank.list_of_templates])
+		self.file.create_dataset('offset', data=[template.filter_metadata()['offset'] for template in templatebank.list_of_templates])
+		for name, dtype in [('match', np.float32), ('phase', np.float32), ('index', np.int32)]:
+			self.file.create_dataset(name, shape=(self.num, self.num_segments), dtype=dtype, chunks=chunks, compression='lzf')
+
+	def add(self, matches, indices, phis):
+		self.buffer.append((matches, indices, phis))
+		if len(self.buffer) == self.blocksize:
+			self.flush()
+
+	def flush(self):
+		if not self.buffer:
+			return
+		start, end = self.count, self.count+len(self.buffer)
+		self.file['match'][start:end] = np.array([result[0] for result in self.buffer], dtype=np.float32)
+		self.file['index'][start:end] = np.array([result[1] for result in self.buffer], dtype=np.int32)
+		self.file['phase'][start:end] = np.array([result[2] for result in self.buffer], dtype=np.float32)
+		self.count = end
+		self.file.attrs['num_filtered'] = self.count
+		self.buffer = []
+
+	def close(self, complete=True):
+		'Write the remaining results and replace an older segment results file. If not complete (canceled), the older file is kept.'
+		self.flush()
+		self.file.close()
+		if complete:
+			os.replace(self.path+'.tmp', self.path)
+		else:
+			os.remove(self.path+'.tmp')
+
+def query_template(filename, templatename):
+	'Return match, time, phase (arrays over all segments) of one template from a segment results file.'
+	with h5py.File(filename, 'r') as f:
+		names = f['templatename'].asstr()[:]
+		row = int(np.flatnonzero(names == templatename)[0])
+		indices = f['index'][row]
+		times = f['segment_start'][:] + indices*f.attrs['delta_t'] - f['offset'][row]
+		return f['match'][row], times, f['phase'][row]
+
+def query_time_window(filename, start, end, min_match=0.):
+	'Return all matches (above min_match) of any template with time of match in [start, end) from a segment results file, sorted by match.'
+	# Only the segments that can contain times of match inside the window are read.
+	with h5py.File(filename, 'r') as f:
+		num = f.attrs['num_filtered']
+		delta_t = f.attrs['delta_t']
+		segment_start = f['segment_start'][:]
+		offset = f['offset'][:num]
+		# time of match in segment i lies in [segment_start - offset, segment_start + segment_duration - offset)
+		first = int(np.searchsorted(segment_start, start-f.attrs['segment_duration']+offset.min(), side='right'))
+		last = int(np.searchsorted(segment_start, end+offset.max(), side='left'))
+		names = f['templatename'].asstr()[:num]
+		matches = f['match'][:num, first:last]
+		indices = f['index'][:num, first:last]
+		phis = f['phase'][:num, first:last]
+	times = segment_start[first:last][np.newaxis,:] + indices*delta_t - offset[:,np.newaxis]
+	selected = (times >= start) & (times < end) & (matches > min_match)
+	rows, columns = np.nonzero(selected)
+	order = np.argsort(matches[rows, columns])[::-1]
+	rows, columns = rows[order], columns[order]
+	dtype = [('templatename', name_dtype(names)), ('match', np.float64), ('time', np.float64), ('phase', np.float64), ('segment', np.int64)]
+	result = np.array(np.zeros(len(rows)), dtype=dtype)
+	result['templatename'] = names[rows]
+	result['match'] = matches[rows, columns]
+	result['time'] = times[rows, columns]
+	result['phase'] = phis[rows, columns]
+	result['segment'] = columns+first
+	return result
+
+def query_events(filename, number=10, min_separation=0.5):
+	'Return the number best events of a segment results file: best matching template and time, with at least min_separation s between the events.'
+	with h5py.File(filename, 'r') as f:
+		num = f.attrs['num_filtered']
+		delta_t = f.attrs['delta_t']
+		segment_start = f['segment_start'][:]
+		offset = f['offset'][:num]
+		names = f['templatename'].asstr()[:num]
+		# best template of every segment, read in blocks of templates
+		columns = np.arange(len(segment_start))
+		best_rows = np.zeros(len(segment_start), dtype=np.int64)
+		best_matches = np.full(len(segment_start), -1.)
+		times = np.zeros(len(segment_start))
+		phis = np.zeros(len(segment_start))
+		for block in range(0, num, 256):
+			end = min(block+256, num)
+			matches = f['match'][block:end]
+			rows = np.argmax(matches, axis=0)
+			better = matches[rows, columns] > best_matches
+			best_rows[better] = rows[better]+block
+			best_matches[better] = matches[rows, columns][better]
+			times[better] = (segment_start + f['index'][block:end][rows, columns]*delta_t - offset[rows+block])[better]
+			phis[better] = f['phase'][block:end][rows, columns][better]
+	events = []
+	for column in np.argsort(best_matches)[::-1]:
+		if len(events) == number:
+			break
+		if all(abs(times[column]-event[2]) >= min_separation for event in events):
+			events.append((names[best_rows[column]], best_matches[column], times[column], phis[column], column))
+	return np.array(events, dtype=[('templatename', name_dtype(names)), ('match', np.float64), ('time', np.float64), ('phase', np.float64), ('segment', np.int64)])
+
+
+### Batch matched filtering
+#   ------------------------
+
+# Several data files are filtered with the same templatebank, which is only loaded once.
+# With more than one worker, every worker process filters whole data files (with all templates), so there is no communication per template.
+# An error with one data file is logged in its savepath and the batch continues with the next file.
+
+def _init_batch_worker(templatebank, preferred_srate, segment_duration):
+	'Make the templatebank and settings available in a batch worker process.'
+	global _batch_templatebank, _batch_settings
+	_batch_templatebank = templatebank
+	_batch_settings = (preferred_srate, segment_duration)
+
+def _matched_filter_file(datafile, templatebank, preferred_srate, segment_duration, workers):
+	'Matched filtering of a single data file (datapath, filename, savepath) as part of a batch. Returns the filename and whether it worked.'
+	datapath, filename, savepath = datafile
+	if os.path.isfile(savepath+'canceled.txt'):
+		return filename, False
+	try:
+		mkdir(savepath, relative=False)
+		data = Data(datapath, filename, savepath, preferred_srate, segment_duration, False)
+		matched_filter_templatebank(data, templatebank, workers)
+		return filename, True
+	except Exception as err:
+		log_error(savepath, filename+' ('+str(datetime.now())+'): Matched filtering failed with '+repr(err)+'\n')
+		return filename, False
+
+def _batch_worker(datafile):
+	return _matched_filter_file(datafile, _batch_templatebank, *_batch_settings, 1)
+
+def matched_filter_batch(list_of_files, templatebank, preferred_srate=4096, segment_duration=1, workers=WORKERS):
+	'Matched filtering of several data files with every template in the templatebank. list_of_files contains (datapath, filename, savepath) of every file.'
+	num = len(list_of_files)
+	done = 0
+	if workers < 2 or num < 2:
+		# one file after the other, the templates are spread across the workers
+		for datafile in list_of_files:
+			filename, success = _matched_filter_file(datafile, templatebank, preferred_srate, segment_duration, workers)
+			done += 1
+			print('Batch matched filtering: '+filename+(' done' if success else ' failed')+' ('+str(done)+' of '+str(num)+').')
+	else:
+		with multiprocessing.Pool(min(workers, num), initializer=_init_batch_worker, initargs=(templatebank, preferred_srate, segment_duration)) as pool:
+			for filename, success in pool.imap_unordered(_batch_worker, list_of_files):
+				done += 1
+				print('Batch matched filtering: '+filename+(' done' if success else ' failed')+' ('+str(done)+' of '+str(num)+').')
+
+
+### Jobs from templatebank_handler_win
+#   -----------------------------------
+
+# On Windows, every job for the container is described by a manifest (json, see Job manifests in templatebank_handler_win) with the task,
+# the data, the template bank and the settings. run_manifest is the entry point for all of them.
+# templatebank_handler_win keeps one container running between jobs, with this module imported (see Warm worker container there).
+# Then the manifests show up in jobpath (name.json). They run one after the other and their output is written to name.done.
+
+def templatebank_from_manifest(manifest):
+	'TemplateBank of the manifest: bankpaths once, templates as [index of the bankpath, filename, row].'
+	templatebank = TemplateBank()
+	bankpaths = manifest['templatebank']['bankpaths']
+	for index, filename, row in manifest['templatebank']['templates']:
+		templatebank.add_template(bankpaths[index], filename, row)
+	return templatebank
+
+def run_manifest(filename):
+	'Run the job described in the manifest file.'
+	with open(filename) as jobfile:
+		manifest = json.load(jobfile)
+	task = manifest['task']
+	if task == 'create_templates':
+		create_templates(np.array(manifest['parameters'], dtype=np.float64).reshape((2,-1)), manifest['bankpath'], manifest['basename'], manifest['attribute'], manifest['freq_domain'], manifest['time_domain'], manifest['packed'])
+		return
+	if task == 'pack_templates':
+		pack_templates(manifest['bankpath'], manifest['filename'])
+		return
+	templatebank = templatebank_from_manifest(manifest)
+	list_of_data = manifest['data']
+	if task == 'matched_filter_batch':
+		list_of_files = [(data['datapath'], data['filename'], data['savepath']) for data in list_of_data]
+		matched_filter_batch(list_of_files, templatebank, list_of_data[0]['preferred_srate'], list_of_data[0]['segment_duration'])
+		return
+	data = list_of_data[0]
+	if task == 'matched_filter_live':
+		threshold = manifest['threshold'] if manifest['threshold'] is not None else LIVE_THRESHOLD
+		matched_filter_live_wav(data['datapath'], data['filename'], data['savepath'], templatebank, data['preferred_srate'], data['segment_duration'], threshold)
+		return
+	data = Data(data['datapath'], data['filename'], data['savepath'], data['preferred_srate'], data['segment_duration'], data['flag_show'])
+	if task == 'matched_filter_templatebank':
+		matched_filter_templatebank(data, templatebank)
+	elif task == 'detect':
+		detect(data, templatebank, manifest.get('list_of_resultfiles'))
+	elif task == 'hierarchical_search':
+		hierarchical_search(data, templatebank)
+	elif task == 'regenerate_merger_plots':
+		regenerate_merger_plots(data, templatebank, manifest['names'])
+	else:
+		raise ValueError('Unknown task in the manifest '+filename+': '+str(task))
+
+def serve_jobs(jobpath, idle_timeout):
+	'Run the manifests showing up in jobpath until there was no job for idle_timeout seconds.'
+	last = time.time()
+	while time.time()-last < idle_timeout:
+		jobs = sorted([f for f in os.listdir(jobpath) if f.endswith('.json')], key=lambda f: os.path.getmtime(jobpath+f))
+		if not jobs:
+			time.sleep(0.1)
+			continue
+		name = jobs[0][:-5]
+		output = io.StringIO()
+		with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+			try:
+				run_manifest(jobpath+name+'.json')
+			except Exception:
+				traceback.print_exc()   # the job failed, but the container keeps serving
+			finally:
+				wait_merger_plots()   # the job is only done with its merger plots; the container might be removed right after (see WarmContainer)
+		os.remove(jobpath+name+'.json')
+		with open(jobpath+name+'.done.tmp', 'w') as donefile:
+			donefile.write(output.getvalue())
+		os.replace(jobpath+name+'.done.tmp', jobpath+name+'.done')
+		last = time.time()
+
+
+### Incremental results cache
+#   --------------------------
+
+# The results of every template with a data file are cached in 00_filter_cache/ of the savepath, one file per data content and filter settings.
+# Templates are identified by a hash of their content (computed when they are created and saved with the filter metadata),
+# so renamed or moved templates are still found, but changed ones are filtered again.
+# A rerun with the same data (e.g. with 200 new templates added to the bank) then only filters the templates that are not in the cache yet.
+
+FILTER_CACHE_INDEX = '00_index.json'
+
+def filter_cache_key(data):
+	'Return the name of the filter cache file of data (without .hdf): content hash of the data file and the filter settings.'
+	mkdir(data.savepath+FILTER_CACHE_DIR, relative=False)
+	datahash = indexed_file_hash(data.datapath+data.filename, data.savepath+FILTER_CACHE_DIR+FILTER_CACHE_INDEX)
+	key = datahash+'_'+str(data.preferred_srate)+'_'+str(data.segment_duration)+'_'+data.converter
+	if data.precision != 'double': key += '_'+data.precision   # results in single precision differ slightly
+	return key
+
+class FilterCache:
+	'Maxmatch and per-segment results (as in the segment results store) of templates with one data file, kept on disk between runs.'
+	def __init__(self, path, num_segments, blocksize=64):
+		self.path = path
+		self.num_segments = num_segments
+		self.blocksize = blocksize
+		self.rows = {}          # template hash: row in the file
+		self.buffer = {}        # template hash: results not written yet; they are written in blocks of blocksize templates (as in SegmentStoreWriter)
+		self.file = None
+		try:
+			self.file = h5py.File(path, 'a')
+			if 'template_hash' in self.file and self.file['match'].shape[1] == num_segments:
+				self.rows = {name: row for row, name in enumerate(self.file['template_hash'].asstr()[:])}
+			else:
+				self.create_datasets()
+		except (OSError, KeyError) as err:
+			print('Could not read the filter cache '+path+': '+repr(err))
+			if self.file is not None:
+				self.file.close()
+				self.file = None
+			try:
+				self.file = h5py.File(path, 'w')   # start over
+				self.create_datasets()
+			except OSError as err:
+				print('Could not save the filter cache '+path+': '+repr(err))
+				self.file = None   # then the new results are only kept in the buffer
+
+	def create_datasets(self):
+		for name in list(self.file.keys()):
+			del self.file[name]
+		chunks = (self.blocksize, max(1, min(self.num_segments, 1024)))
+		self.file.create_dataset('template_hash', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype())
+		self.file.create_dataset('maxmatch', shape=(0,5), maxshape=(None,5), dtype=np.float64)
+		for name, dtype in [('match', np.float32), ('phase', np.float32), ('index', np.int32)]:
+			self.file.create_dataset(name, shape=(0,self.num_segments), maxshape=(None,self.num_segments), dtype=dtype, chunks=chunks, compression='lzf')
+
+	def __contains__(self, key):
+		return key in self.rows or key in self.buffer
+
+	def get(self, key):
+		'Return (Maxmatch, (matches, indices, phis)) of the template with hash key.'
+		if key in self.buffer:
+			return self.buffer[key]
+		row = self.rows[key]
+		Maxmatch = list(self.file['maxmatch'][row])
+		Maxmatch[3] = int(Maxmatch[3])  # the number of the segment is used as index
+		return Maxmatch, (self.file['match'][row], self.file['index'][row], self.file['phase'][row])
+
+	def add(self, key, Maxmatch, segment_results):
+		self.buffer[key] = (Maxmatch, segment_results)
+		if len(self.buffer) >= self.blocksize:
+			self.flush()
+
+	def flush(self):
+		'Append the buffered results to the file, so a crash or cancel later on does not lose them.'
+		if not self.buffer or self.file is None:
+			return
+		try:
+			start = self.file['template_hash'].shape[0]
+			end = start+len(self.buffer)
+			for name in ['template_hash', 'maxmatch', 'match', 'phase', 'index']:
+				self.file[name].resize(end, axis=0)
+			self.file['maxmatch'][start:end] = [[float(value) for value in Maxmatch] for Maxmatch, _ in self.buffer.values()]
+			self.file['match'][start:end] = np.array([segment_results[0] for _, segment_results in self.buffer.values()], dtype=np.float32)
+			self.file['index'][start:end] = np.array([segment_results[1] for _, segment_results in self.buffer.values()], dtype=np.int32)
+			self.file['phase'][start:end] = np.array([segment_results[2] for _, segment_results in self.buffer.values()], dtype=np.float32)
+			self.file['template_hash'][start:end] = list(self.buffer.keys())
+			self.file.flush()
+		except OSError as err:
+			print('Could not save the filter cache '+self.path+': '+repr(err))
+			return
+		for row, key in enumerate(self.buffer, start):
+			self.rows[key] = row
+		self.buffer = {}
+
+	def close(self):
+		'Write the remaining results and close the file.'
+		self.flush()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+		self.buffer = {}
+
+def iterate_templatebank_cached(data, templatebank, filter_cache, workers=1):
+	'As iterate_templatebank with keep_segments, but templates found in filter_cache are not filtered again. New results are added to the cache.'
+	hashes = [template.content_hash() for template in templatebank.list_of_templates]   # saved with the metadata, so no template is loaded here
+	missing = TemplateBank()
+	missing_hashes = set()
+	for template, key in zip(templatebank.list_of_templates, hashes):
+		if not key in filter_cache and not key in missing_hashes:   # the same template twice is only filtered once
+			missing.list_of_templates.append(template)
+			missing_hashes.add(key)
+	print('Matched filtering: '+str(len(hashes)-len(missing.list_of_templates))+' of '+str(len(hashes))+' templates found in the filter cache.')
+	new_results = iterate_templatebank(data, missing, workers, keep_segments=True)
+	try:
+		for key in hashes:
+			if not key in filter_cache:
+				filter_cache.add(key, *next(new_results))
+			yield filter_cache.get(key)
+	finally:
+		new_results.close()
+		filter_cache.close()   # also saves the results of a canceled run
+
+
+### Detection mode
+#   --------------
+
+# For a quick triage, it is enough to know whether any template matches better than match_threshold (section mergerplots in config.ini).
+# The templates are filtered in the order of a prior: the matches of the templates in earlier results (e.g. of similar recordings), best first.
+# Templates without a prior follow in bank order. The filtering stops with the first template above the threshold.
+
+def load_prior(list_of_resultfiles):
+	'Return a dictionary of templatename: best match in any of the result files (00_matched_filtering_results.npz or .dat of earlier runs).'
+	prior = {}
+	for filename in list_of_resultfiles:
+		try:
+			results = load_results(filename)
+		except (OSError, ValueError, KeyError) as err:
+			print('Could not read prior from '+filename+': '+repr(err))
+			continue
+		for name, match in zip(results['templatename'], results['maxmatch']):
+			prior[str(name)] = max(prior.get(str(name), 0.), float(match))
+	return prior
+
+def prior_match(prior, shortname):
+	'Prior of the template shortname, -1 if there is none (result files of older versions cut the names to 40 characters).'
+	if shortname in prior:
+		return prior[shortname]
+	if len(shortname) > 40:
+		return prior.get(shortname[:40], -1.)
+	return -1.
+
+def detect(data, templatebank, list_of_resultfiles=None, threshold=None, progress_callback=None):
+	'Filter the data with the templates in the order of the prior (see load_prior) and stop at the first template whose match exceeds threshold.'
+	# Without result files, the results of an earlier run on the same data (in its savepath) are used, if there are any.
+	if list_of_resultfiles is None:
+		list_of_resultfiles = [data.savepath+f for f in [RESULTS_FILENAME, '00_matched_filtering_results.dat'] if os.path.isfile(data.savepath+f)][:1]
+	if threshold is None:
+		threshold = config.getfloat('mergerplots', 'match_threshold')
+	prior = load_prior(list_of_resultfiles)
+	bank_order = range(len(templatebank.list_of_templates))
+	order = sorted(bank_order, key=lambda index: -prior_match(prior, templatebank.list_of_templates[index].shortname))   # sorted() is stable, so bank order stays without prior
+	ordered_bank = TemplateBank()
+	ordered_bank.list_of_templates = [templatebank.list_of_templates[index] for index in order]
+
+	num = len(order)
+	progress = Progress(data.savepath, '00_progress_mf.dat', num+2, progress_callback)
+	hit = None
+	best = None
+	checked = 0
+	maxmatches = iterate_templatebank(data, ordered_bank, WORKERS)
+	for template in ordered_bank.list_of_templates:
+		if progress.update(checked+1):
+			print('Detection canceled by user.')
+			break
+		Maxmatch = next(maxmatches)
+		checked += 1
+		if best is None or Maxmatch[0] > best[1][0]:
+			best = [template, Maxmatch]
+		if Maxmatch[0] > threshold:
+			hit = [template, Maxmatch]
+			break
+	maxmatches.close()  # stops the worker processes, if there are any left
+	progress.update(num+1, force=True)
+
+	# report the hit (or the best match, if there was none)
+	header = 'Detection in '+data.shortname+' with threshold '+str(threshold)+': \n'
+	header += 'detected, templatename, match, time of match, template-m1, template-m2, templates checked, templates skipped'
+	dtype = [('detected', np.int64), ('templatename', name_dtype([template.shortname for template in ordered_bank.list_of_templates])), ('maxmatch', np.float64), ('maxtime', np.float64), ('m1', np.float64), ('m2', np.float64), ('checked', np.int64), ('skipped', np.int64)]
+	writedata = np.array(np.zeros(0), dtype=dtype)
+	if hit is not None:
+		template, Maxmatch = hit
+		print('Detected '+template.shortname+' with match '+str(round(Maxmatch[0],3))+' at t = '+str(round(Maxmatch[1],3))+' s. Checked '+str(checked)+' templates, skipped '+str(num-checked)+'.')
+		plot_merger(data, template, Maxmatch)
+	elif best is not None:
+		template, Maxmatch = best
+		print('No template above the threshold of '+str(threshold)+'. Checked '+str(checked)+' templates, best match '+str(round(Maxmatch[0],3))+' with '+template.shortname+'.')
+	if best is not None:
+		writedata = np.array([(hit is not None, template.shortname, Maxmatch[0], Maxmatch[1], template.m1, template.m2, checked, num-checked)], dtype=dtype)
+	np.savetxt(data.savepath+'00_detection.dat', writedata, fmt=['%i', '%s', '%f', '%f', '%f', '%f', '%i', '%i'], header=header)
+	return hit, checked, num-checked
+
+
+### Hierarchical search
+#   --------------------
+
+# Instead of a dense grid of templates, the data is filtered with a coarse template bank first.
+# Around the num_best best matching templates, new templates are created on a 3x3 grid in (Mc, r) and filtered; then the grid gets finer (steps halved).
+# This is repeated until the best match improves by less than min_improvement (or max_levels is reached).
+# The new templates are only kept in memory. Their parameters and matches are saved in 00_hierarchical_search.dat.
+
+HIERARCHICAL_NUM_BEST = config.getint('hierarchical', 'num_best', fallback=3)
+HIERARCHICAL_STEP_MC = config.getfloat('hierarchical', 'step_mc', fallback=0.1)     # relative step in Mc on the first level
+HIERARCHICAL_STEP_R = config.getfloat('hierarchical', 'step_r', fallback=0.1)       # step in r on the first level
+HIERARCHICAL_MIN_IMPROVEMENT = config.getfloat('hierarchical', 'min_improvement', fallback=0.001)
+HIERARCHICAL_MAX_LEVELS = config.getint('hierarchical', 'max_levels', fallback=6)
+
+def chirp_mass(m1, m2):
+	return np.power(m1*m2, 0.6)/np.power(m1+m2, 0.2)
+
+def mass_ratio(m1, m2):
+	return min(m1, m2)/max(m1, m2)
+
+def masses_from_chirp(Mc, r):
+	'Return m1, m2 (m1 >= m2) from chirp mass Mc and mass ratio r (as in create_templates).'
+	if r > 1: r = 1./r
+	m2 = Mc*np.power(np.power(r,3)+np.power(r,2), 0.2)
+	return m2/r, m2
+
+def refine_parameters(Mc, r, step_mc, step_r):
+	'Return the (Mc, r) of the 3x3 grid around Mc, r without the center. r is kept inside (0,1].'
+	grid = []
+	for factor in [1-step_mc, 1, 1+step_mc]:
+		for r_new in [r-step_r, r, r+step_r]:
+			r_new = min(r_new, 1.)
+			if (factor, r_new) != (1, r) and r_new > 0:
+				grid.append((Mc*factor, r_new))
+	return grid
+
+def hierarchical_search(data, templatebank, num_best=HIERARCHICAL_NUM_BEST, step_mc=HIERARCHICAL_STEP_MC, step_r=HIERARCHICAL_STEP_R, min_improvement=HIERARCHICAL_MIN_IMPROVEMENT, max_levels=HIERARCHICAL_MAX_LEVELS, progress_callback=None):
+	'Search the best matching template parameters: filter the coarse templatebank, then create and filter finer templates around the best matches.'
+	progress = Progress(data.savepath, '00_progress_mf.dat', max_levels+2, progress_callback)
+	# the approximant cache of the template bank (of the directory of its first template), as for creating templates there
+	bankpath = templatebank.list_of_templates[0].path if templatebank.list_of_templates else data.savepath
+	apx_cache = ApproximantCache(bankpath+APX_CACHE_FILENAME)
+	results = []   # [template, Maxmatch, level] for every filtered template
+	known = set()  # rounded (Mc, r) of every filtered template, to never create a template twice
+
+	def filter_templates(templates, level):
+		bank = TemplateBank()
+		bank.list_of_templates = list(templates)
+		maxmatches = iterate_templatebank(data, bank, WORKERS)
+		for template in templates:
+			if progress.update(level):
+				maxmatches.close()
+				return False
+			results.append([template, next(maxmatches), level])
+			known.add((round(chirp_mass(template.m1, template.m2), 4), round(mass_ratio(template.m1, template.m2), 4)))
+		maxmatches.close()
+		return True
+
+	# coarse level
+	canceled = not filter_templates(templatebank.list_of_templates, 0)
+	best = max([result[1][0] for result in results], default=0.)
+	print('Hierarchical search: best match of the coarse template bank is '+str(round(best,4)))
+
+	# finer levels
+	for level in range(1, max_levels+1):
+		if canceled or not results:
+			break
+		progress.update(level, force=True)
+		scale = 0.5**(level-1)
+		centers = sorted(results, key=lambda result: result[1][0], reverse=True)[:num_best]
+		templates = []
+		for template, _, _ in centers:
+			for Mc, r in refine_parameters(chirp_mass(template.m1, template.m2), mass_ratio(template.m1, template.m2), step_mc*scale, step_r*scale):
+				key = (round(Mc, 4), round(r, 4))
+				m1, m2 = masses_from_chirp(Mc, r)
+				if key in known or not 0.49<m1+m2<100.1:
+					continue
+				known.add(key)
+				name = 'hier_McR_'+str(round(Mc,3))+'-'+str(int(np.round(1000*r))).zfill(4)
+				created = make_template_any_apx(m1, m2, data.preferred_srate, data.segment_duration, errorname=name, savepath=data.savepath, apx_cache=apx_cache)
+				if created is not None:
+					templates.append(GeneratedTemplate(name, m1, m2, created[0]))
+		canceled = not filter_templates(templates, level)
+		new_best = max([result[1][0] for result in results])
+		print('Hierarchical search: best match after level '+str(level)+' ('+str(len(templates))+' new templates) is '+str(round(new_best,4)))
+		if new_best-best < min_improvement:
+			break
+		best = new_best
+	apx_cache.save()
+	if canceled:
+		print('Hierarchical search canceled by user.')
+
+	# save results sorted by match and plot the best one
+	progress.update(max_levels+1, force=True)
+	results.sort(key=lambda result: result[1][0], reverse=True)
+	dtype = [('templatename', name_dtype([result[0].shortname for result in results])), ('maxmatch', np.float64), ('maxtime', np.float64), ('m1', np.float64), ('m2', np.float64), ('M', np.float64), ('r', np.float64), ('Mc', np.float64), ('level', np.int64)]
+	writedata = np.array(np.zeros(len(results)), dtype=dtype)
+	for index, (template, Maxmatch, level) in enumerate(results):
+		writedata[index] = template.shortname, Maxmatch[0], Maxmatch[1], template.m1, template.m2, template.m1+template.m2, mass_ratio(template.m1, template.m2), chirp_mass(template.m1, template.m2), level
+	header = 'Hierarchical search results of '+data.shortname+' (sorted by match): \n'
+	header += 'templatename, match, time of match, template-m1, template-m2, template-M, template-R, template-Mc, level'
+	np.savetxt(data.savepath+'00_hierarchical_search.dat', writedata, fmt=['%s', '%f', '%f', '%f', '%f', '%f', '%f', '%f', '%i'], header=header)
+	if results:
+		plot_merger(data, results[0][0], results[0][1])
+		print('Hierarchical search: best match '+str(round(results[0][1][0],4))+' with '+results[0][0].shortname+' (m1 = '+str(round(results[0][0].m1,3))+', m2 = '+str(round(results[0][0].m2,3))+')')
+	return results
+
+
+### Live matched filtering
+#   ----------------------
+
+# For a recording that is still being written (a growing .wav-file or raw PCM from a pipe), every segment is filtered with the whole template bank as soon as it is complete.
+# The samples run through the same streaming resampling and segmentation as in segment_data, so the segments are the same as for the finished file.
+# Every segment is only filtered once; the latency is about a segment_duration plus the time to filter one segment with the bank.
+
+def read_wav_header(filename):
+	'Read srate, nchannels, sampwidth, the position of the samples and their size (0 if unknown) from the header of a (possibly unfinished) wav-file.'
+	# The wave module can not be used here: it relies on the sizes in the header, which are not written before the recording is finished.
+	with open(filename, 'rb') as f:
+		header = f.read(2**16)
+	if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+		raise ValueError(filename+' is not a wav-file.')
+	position = 12
+	fmt = None
+	while position+8 <= len(header):
+		chunk_id = header[position:position+4]
+		chunk_size = int.from_bytes(header[position+4:position+8], 'little')
+		if chunk_id == b'fmt ':
+			fmt = header[position+8:position+24]
+		elif chunk_id == b'data':
+			if fmt is None or len(fmt) < 16:
+				break
+			nchannels = int.from_bytes(fmt[2:4], 'little')
+			srate = int.from_bytes(fmt[4:8], 'little')
+			sampwidth = int.from_bytes(fmt[14:16], 'little')//8
+			if chunk_size == 0xFFFFFFFF: chunk_size = 0   # some recorders write this while recording
+			return srate, nchannels, sampwidth, position+8, chunk_size
+		position += 8+chunk_size+chunk_size%2
+	return None   # header not (completely) written yet
+
+def follow_wav(filename, channel='unclear', chunk_frames=LIVE_CHUNK_FRAMES, poll_interval=LIVE_POLL_INTERVAL, idle_timeout=LIVE_IDLE_TIMEOUT, canceled=None):
+	'Yield the track of a wav-file that is still being written, chunk by chunk, as soon as new samples arrive. Returns after idle_timeout s without new samples.'
+	# canceled is a function returning True, if the user canceled (e.g. Progress.check); it is asked while waiting for new samples.
+	# channel as in load_wav; for stereo, 'greater' (and 'unclear') is decided with the first chunk since the rest of the file does not exist yet.
+	if not channel in ['mono', 'left', 'right', 'average', 'greater', 'unclear']:
+		raise ValueError('channel can only be: mono, left, right, average, greater, unclear. But I got: ',channel)
+	last_growth = time.time()
+	header = None
+	while header is None:
+		if os.path.isfile(filename): header = read_wav_header(filename)
+		if header is None:
+			if time.time()-last_growth > idle_timeout or (canceled is not None and canceled()): return
+			time.sleep(poll_interval)
+	srate, nchannels, sampwidth, position, _ = header
+	framesize = nchannels*sampwidth
+	dtype = f'int{sampwidth*8}'
+	if channel == 'unclear':
+		channel = 'greater' if nchannels == 2 else 'mono'
+
+	with open(filename, 'rb') as f:
+		f.seek(position)
+		while True:
+			# the header gets the final size of the samples, when the recording is finished. Anything after that (metadata chunks) is no audio.
+			_, _, _, start, size = read_wav_header(filename)
+			available = start+size-f.tell() if size else os.path.getsize(filename)-f.tell()
+			available = min(available, chunk_frames*framesize)//framesize*framesize
+			if available <= 0:
+				if time.time()-last_growth > idle_timeout or (canceled is not None and canceled()): return
+				time.sleep(poll_interval)
+				continue
+			last_growth = time.time()
+			interleaved = np.frombuffer(f.read(available), dtype=dtype)
+			if channel == 'greater':
+				stereo = np.reshape(interleaved, (-1,nchannels)).astype(np.float64)
+				channel = 'right' if np.sum(np.square(stereo[:,1])) > np.sum(np.square(stereo[:,0])) else 'left'
+			yield select_channel(interleaved, nchannels, channel)
+
+def follow_pcm(stream, nchannels=1, sampwidth=2, channel='unclear', chunk_frames=LIVE_CHUNK_FRAMES):
+	'Yield the track of raw interleaved PCM samples read from stream (e.g. sys.stdin.buffer), chunk by chunk, until the stream ends.'
+	framesize = nchannels*sampwidth
+	dtype = f'int{sampwidth*8}'
+	if channel == 'unclear':
+		channel = 'greater' if nchannels == 2 else 'mono'
+	rest = b''
+	for buffer in iter(lambda: stream.read(chunk_frames*framesize), b''):
+		buffer = rest+buffer
+		usable = len(buffer)//framesize*framesize
+		buffer, rest = buffer[:usable], buffer[usable:]   # keep incomplete frames for the next chunk
+		if not buffer:
+			continue
+		interleaved = np.frombuffer(buffer, dtype=dtype)
+		if channel == 'greater':
+			stereo = np.reshape(interleaved, (-1,nchannels)).astype(np.float64)
+			channel = 'right' if np.sum(np.square(stereo[:,1])) > np.sum(np.square(stereo[:,0])) else 'left'
+		yield select_channel(interleaved, nchannels, channel)
+
+def iter_live_matches(segments, templatebank, threshold=LIVE_THRESHOLD):
+	'Filter every segment with every template as soon as the segment is complete. Yields segment index, segment and the list of matches above threshold.'
+	# every match in the list is [templatename, match, time, phase, index in segment]
+	for count,segment in enumerate(segments):
+		delta_t = segment.delta_t
+		delta_f = 1./(len(segment)*delta_t)
+		segment_spectra = stack_spectra([segment])
+		segment_norms = sigmasq_segments(segment_spectra, delta_f)
+		start_time = float(segment.start_time)
+		hits = []
+		for template in templatebank.list_of_templates:
+			tmp = template.frequency_series
+			metadata = template.filter_metadata()
+			matches, indices, phis, _ = batched_matched_filter(segment_spectra, segment_norms, delta_f, tmp, tmp.delta_f,
+				h_norm=metadata['sigmasq'], kmin=metadata['kmin'], kmax=metadata['kmax'])
+			if matches[0] > threshold:
+				hits.append([template.shortname, matches[0], start_time+indices[0]*delta_t-metadata['offset'], phis[0], indices[0]])
+		yield count, segment, hits
+
+def matched_filter_live(chunks, srate, templatebank, savepath, shortname, preferred_srate=4096, segment_duration=1, threshold=LIVE_THRESHOLD, progress_callback=None, progress=None):
+	'Matched filtering of a growing recording (chunks as from follow_wav or follow_pcm) with every template in the templatebank. Matches above threshold are reported immediately.'
+	# progress can be a Progress object shared with the source of the chunks (see matched_filter_live_wav); the number of segments is not known in advance.
+	if progress is None:
+		progress = Progress(savepath, '00_progress_mf.dat', 0, progress_callback)
+	segments = segment_chunks(resample_chunks(chunks, srate, preferred_srate, LIVE_CHUNK_FRAMES), preferred_srate, segment_duration)
+	header = 'Live Matched Filtering results of '+shortname+' (matches above '+str(threshold)+'): \n'
+	header += 'templatename, match, time of match, phase, segment'
+	all_hits = []
+	with open(savepath+'00_live_matches.dat', 'w') as f:
+		f.write('# '+header.replace('\n', '\n# ')+'\n')
+		f.flush()
+		for count, segment, hits in iter_live_matches(segments, templatebank, threshold):
+			for hit in hits:
+				print('Live match: '+hit[0]+' with match '+str(round(hit[1],3))+' at t = '+str(round(hit[2],3))+' s')
+				f.write('%s %f %f %f %i\n' % (hit[0], hit[1], hit[2], hit[3], count))
+				all_hits.append(hit+[count])
+			f.flush()
+			if progress.update(count+1):
+				print('Live matched filtering canceled by user.')
+				break
+	progress.update(progress.done, force=True)
+	return all_hits
+
+def matched_filter_live_wav(datapath, filename, savepath, templatebank, preferred_srate=4096, segment_duration=1, threshold=LIVE_THRESHOLD, progress_callback=None):
+	'Matched filtering of a wav-file while it is still being written (see matched_filter_live).'
+	progress = Progress(savepath, '00_progress_mf.dat', 0, progress_callback)
+	header = None
+	start = time.time()
+	while header is None:   # the recording might not have started yet
+		if os.path.isfile(datapath+filename): header = read_wav_header(datapath+filename)
+		if header is None:
+			if time.time()-start > LIVE_IDLE_TIMEOUT or progress.check():
+				print('No recording found at '+datapath+filename+'.')
+				return []
+			time.sleep(LIVE_POLL_INTERVAL)
+	chunks = follow_wav(datapath+filename, canceled=progress.check)
+	return matched_filter_live(chunks, header[0], templatebank, savepath, filename[:-4], preferred_srate, segment_duration, threshold, progress=progress)
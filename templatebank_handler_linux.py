@@ -1,6 +1,13 @@
 import os
+import numpy as np
 import mics_pycbc_interface as mpi
 
+PACKED_EXTENSION = mpi.PACKED_EXTENSION
+RESULTS_FILENAME = mpi.RESULTS_FILENAME
+load_results = mpi.load_results
+PROGRESS_CALLBACK = True   # progress and canceling go through progress_callback (see Progress in mics_pycbc_interface), not through files
+mpi.MERGER_PLOT_WORKERS = 0   # here, mpi runs inside the GUI process (in a QThread), which should not be forked for a background pool; so the merger plots are drawn right away
+
 ### About the templatebank_handler_linux
 #   ------------------------------------
 
@@ -22,31 +29,48 @@ class TemplateBank:
 	
 	def add_template(self, bankpath, filename, flag_print=True):
 		'Add a single file to the TemplateBank.'
+		if filename.endswith(PACKED_EXTENSION):
+			self.add_packed_bank(bankpath, filename, flag_print)
+			return
 		self.list_of_templates.append(Template(bankpath, filename))
 		if flag_print: print('Added ', self.list_of_templates[-1].shortname, ' to the template bank.')
+
+	def add_packed_bank(self, bankpath, filename, flag_print=True):
+		'Add all templates of a packed template bank (.bank.npy) to the TemplateBank.'
+		names = np.load(bankpath+filename, mmap_mode='r')['name']
+		for row,name in enumerate(names):
+			if name:  # unused rows have no name
+				self.list_of_templates.append(Template(bankpath, filename, row, str(name)))
+		if flag_print: print('Added the packed template bank ', filename, ' to the template bank.')
 	
 	def add_directory(self, path):
-		'Add all .hdf-files in path to the TemplateBank.'
-		listofnames = [f for f in os.listdir(path) if f.endswith('.hdf')]
+		'Add all .hdf-files and packed template banks in path to the TemplateBank.'
+		listofnames = [f for f in os.listdir(path) if f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)]
 		listofnames.sort()
 		for filename in listofnames:
 			self.add_template(path, filename, flag_print=False)
-		print('Added all .hdf files in '+path+' to the template bank.')
+		print('Added all .hdf files and packed template banks in '+path+' to the template bank.')
 
-	def create_templates(self, array_masses, bankpath, basename, attribute='individual', freq_domain=True, time_domain=False):
+	def create_templates(self, array_masses, bankpath, basename, attribute='individual', freq_domain=True, time_domain=False, packed=False, progress_callback=None):
 		'Creates templates and adds them to the templatebank.'
-		list_old_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf')]
-		mpi.create_templates(array_masses, bankpath, basename, attribute, freq_domain, time_domain)
+		list_old_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)]
+		mpi.create_templates(array_masses, bankpath, basename, attribute, freq_domain, time_domain, packed, progress_callback)
 		if freq_domain:
-			list_new_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf') and f not in list_old_templates]
+			num_old_templates = len(self.list_of_templates)
+			list_new_templates = [f for f in os.listdir(bankpath) if (f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)) and f not in list_old_templates]
 			for filename in list_new_templates: self.add_template(bankpath, filename, flag_print=False)
-			print('Added '+str(len(list_new_templates))+' new templates to the template bank.')
+			print('Added '+str(len(self.list_of_templates)-num_old_templates)+' new templates to the template bank.')
+
+	def pack_directory(self, path, filename):
+		'Packs all .hdf-files in path into the single packed template bank path+filename (which should end with .bank.npy).'
+		mpi.pack_templates(path, filename)
 
 class Template:
-	def __init__(self, bankpath, filename):
+	def __init__(self, bankpath, filename, row=None, shortname=None):
 		self.bankpath = bankpath
 		self.filename = filename
-		self.shortname = filename[:-4]
+		self.row = row          # row inside a packed template bank; None for single .hdf-files
+		self.shortname = filename[:-4] if shortname is None else shortname
 		
 class Data:
 	def __init__(self, datapath, filename):
@@ -60,16 +84,57 @@ class Data:
 		self.segment_duration = 1
 		# self.ending = '.wav'
 
-	def matched_filter(self, templatebank, debugmode=False):
+	def matched_filter(self, templatebank, debugmode=False, progress_callback=None):
 		'Performs Matched Filtering with every template in the templatebank.'
 		if not isinstance(templatebank, TemplateBank):
 			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
 		mkdir(self.savepath, relative=False)
 		mpi_templatebank = mpi.TemplateBank()
 		for template in templatebank.list_of_templates:
-			mpi_templatebank.add_template(template.bankpath, template.filename) # Not pretty, since every template now is two objects: one here in the handler and one in mpi. But it's easy and it works.
+			mpi_templatebank.add_template(template.bankpath, template.filename, template.row) # Not pretty, since every template now is two objects: one here in the handler and one in mpi. But it's easy and it works.
 		mpi_data = mpi.Data(self.datapath, self.filename, self.savepath, self.preferred_srate, self.segment_duration, False)
-		mpi.matched_filter_templatebank(mpi_data, mpi_templatebank)
+		mpi.matched_filter_templatebank(mpi_data, mpi_templatebank, progress_callback=progress_callback)
+
+	def detect(self, templatebank, list_of_resultfiles=None, progress_callback=None):
+		'Checks only whether any template matches better than the match_threshold, trying the templates that matched best in list_of_resultfiles (earlier results) first.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		mpi_templatebank = mpi.TemplateBank()
+		for template in templatebank.list_of_templates:
+			mpi_templatebank.add_template(template.bankpath, template.filename, template.row)
+		mpi_data = mpi.Data(self.datapath, self.filename, self.savepath, self.preferred_srate, self.segment_duration, False)
+		return mpi.detect(mpi_data, mpi_templatebank, list_of_resultfiles, progress_callback=progress_callback)
+
+	def hierarchical_search(self, templatebank, progress_callback=None):
+		'Searches the best matching template parameters, starting with the templatebank as coarse bank and creating finer templates around the best matches.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		mpi_templatebank = mpi.TemplateBank()
+		for template in templatebank.list_of_templates:
+			mpi_templatebank.add_template(template.bankpath, template.filename, template.row)
+		mpi_data = mpi.Data(self.datapath, self.filename, self.savepath, self.preferred_srate, self.segment_duration, False)
+		mpi.hierarchical_search(mpi_data, mpi_templatebank, progress_callback=progress_callback)
+
+	def regenerate_merger_plots(self, templatebank, names=None):
+		'Creates the merger plots again from the saved results of the last matched filtering (e.g. after changing the settings for merger plots), without filtering.'
+		mpi_templatebank = mpi.TemplateBank()
+		for template in templatebank.list_of_templates:
+			mpi_templatebank.add_template(template.bankpath, template.filename, template.row)
+		mpi_data = mpi.Data(self.datapath, self.filename, self.savepath, self.preferred_srate, self.segment_duration, False)
+		mpi.regenerate_merger_plots(mpi_data, mpi_templatebank, names)
+
+	def matched_filter_live(self, templatebank, threshold=None, progress_callback=None):
+		'Performs Matched Filtering with every template in the templatebank while the data file is still being recorded.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		mpi_templatebank = mpi.TemplateBank()
+		for template in templatebank.list_of_templates:
+			mpi_templatebank.add_template(template.bankpath, template.filename, template.row)
+		if threshold is None: threshold = mpi.LIVE_THRESHOLD
+		return mpi.matched_filter_live_wav(self.datapath, self.filename, self.savepath, mpi_templatebank, self.preferred_srate, self.segment_duration, threshold, progress_callback)
 
 	def set_datapath(self, newpath):
 		self.datapath = newpath
@@ -96,6 +161,22 @@ class Data:
 		self.ending = new_file_extension
 
 
+def matched_filter_batch(list_of_data, templatebank, debugmode=False):
+	'Performs Matched Filtering of every Data object in list_of_data with every template in the templatebank (which is only loaded once).'
+	if not isinstance(templatebank, TemplateBank):
+		raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+	if not list_of_data:
+		return
+	mpi_templatebank = mpi.TemplateBank()
+	for template in templatebank.list_of_templates:
+		mpi_templatebank.add_template(template.bankpath, template.filename, template.row)
+	list_of_files = [(data.datapath, data.filename, data.savepath) for data in list_of_data]
+	mpi.matched_filter_batch(list_of_files, mpi_templatebank, list_of_data[0].preferred_srate, list_of_data[0].segment_duration)
+
+def data_from_directory(path, ending='.wav'):
+	'Return a list of Data objects for every file in path ending with ending.'
+	return [Data(path, filename) for filename in sorted(os.listdir(path)) if filename.endswith(ending)]
+
 def mkdir( dirname, relative=True ):
 	'Creates the directory dirname.'
 	if relative:
@@ -1,13 +1,29 @@
 import os
+import json
+import time
+import hashlib
+import threading
+import itertools
 from configparser import ConfigParser
 
 import docker
+import numpy as np
 from pathlib import Path
 
 config = ConfigParser()
 config.read('config.ini')
 debugmode = config.getboolean('main', 'debugmode')
 
+PACKED_EXTENSION = '.bank.npy'  # packed template banks, see mics_pycbc_interface
+RESULTS_FILENAME = '00_matched_filtering_results.npz'  # results of the matched filtering, see mics_pycbc_interface
+# keep one worker container running between jobs (see Warm worker container below)
+WARM_CONTAINER = config.getboolean('performance', 'warm_container', fallback=False)
+CONTAINER_IDLE_TIMEOUT = config.getfloat('performance', 'container_idle_timeout', fallback=600)   # in s
+CONTAINER_NAME = 'mdaamkit_mpi_worker'
+JOBS_DIR = os.getcwd()+'/00_jobs/'   # mounted as /jobs/ into the worker container
+RESAMPLE_CACHE_DIR = os.getcwd()+'/00_resampled/'   # resample cache of all recordings, mounted as /00_resampled/ (where mpi expects it, see mics_pycbc_interface)
+PROGRESS_CALLBACK = False  # the container can not call back into the GUI; progress and canceling go through files in the savepath (see Progress in mics_pycbc_interface)
+
 
 ### About the templatebank_handler and mics_pycbc_interface
 #   -------------------------------------------------------
@@ -25,34 +41,55 @@ class TemplateBank:
 	
 	def add_template(self, bankpath, filename, flag_print=True):
 		'Add a single file to the TemplateBank.'
+		if filename.endswith(PACKED_EXTENSION):
+			self.add_packed_bank(bankpath, filename, flag_print)
+			return
 		self.list_of_templates.append(Template(bankpath, filename))
 		if not bankpath in self.list_of_bankpaths: self.list_of_bankpaths.append(bankpath)
 		if flag_print: print('Added ', self.list_of_templates[-1].shortname, ' to the template bank.')
+
+	def add_packed_bank(self, bankpath, filename, flag_print=True):
+		'Add all templates of a packed template bank (.bank.npy) to the TemplateBank.'
+		names = np.load(bankpath+filename, mmap_mode='r')['name']
+		for row,name in enumerate(names):
+			if name:  # unused rows have no name
+				self.list_of_templates.append(Template(bankpath, filename, row, str(name)))
+		if not bankpath in self.list_of_bankpaths: self.list_of_bankpaths.append(bankpath)
+		if flag_print: print('Added the packed template bank ', filename, ' to the template bank.')
 	
 	def add_directory(self, path):
-		'Add all .hdf-files in path to the TemplateBank.'
-		listofnames = [f for f in os.listdir(path) if f.endswith('.hdf')]
+		'Add all .hdf-files and packed template banks in path to the TemplateBank.'
+		listofnames = [f for f in os.listdir(path) if f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)]
 		listofnames.sort()
 		for filename in listofnames:
 			self.add_template(path, filename, flag_print=False)
-		print('Added all .hdf files in '+path+' to the template bank.')
+		print('Added all .hdf files and packed template banks in '+path+' to the template bank.')
 
-	def create_templates(self, array_masses, bankpath, basename, attribute='individual', freq_domain=True, time_domain=False):
+	def create_templates(self, array_masses, bankpath, basename, attribute='individual', freq_domain=True, time_domain=False, packed=False, progress_callback=None):
 		'Creates templates and adds them to the templatebank.'
+		# progress_callback is only there to have the same arguments as on linux; it is not used (see PROGRESS_CALLBACK).
 		connection = MPIConnection()
 		if debugmode: connection.update_mpi()
-		list_old_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf')]
-		connection.Create_Templates(array_masses, bankpath, basename, attribute, freq_domain, time_domain)
+		list_old_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)]
+		connection.Create_Templates(array_masses, bankpath, basename, attribute, freq_domain, time_domain, packed)
 		if freq_domain:
-			list_new_templates = [f for f in os.listdir(bankpath) if f.endswith('.hdf') and f not in list_old_templates]
+			num_old_templates = len(self.list_of_templates)
+			list_new_templates = [f for f in os.listdir(bankpath) if (f.endswith('.hdf') or f.endswith(PACKED_EXTENSION)) and f not in list_old_templates]
 			for filename in list_new_templates: self.add_template(bankpath, filename, flag_print=False)
-			print('Added '+str(len(list_new_templates))+' new templates to the template bank.')
+			print('Added '+str(len(self.list_of_templates)-num_old_templates)+' new templates to the template bank.')
+
+	def pack_directory(self, path, filename):
+		'Packs all .hdf-files in path into the single packed template bank path+filename (which should end with .bank.npy).'
+		connection = MPIConnection()
+		if debugmode: connection.update_mpi()
+		connection.Pack_Templates(path, filename)
 
 class Template:
-	def __init__(self, bankpath, filename):
+	def __init__(self, bankpath, filename, row=None, shortname=None):
 		self.bankpath = bankpath
 		self.filename = filename
-		self.shortname = filename[:-4]
+		self.row = row          # row inside a packed template bank; None for single .hdf-files
+		self.shortname = filename[:-4] if shortname is None else shortname
 		
 class Data:
 	def __init__(self, datapath, filename):
@@ -66,7 +103,7 @@ class Data:
 		self.segment_duration = 1
 		# self.ending = '.wav'
 
-	def matched_filter(self, templatebank, debugmode=False):
+	def matched_filter(self, templatebank, debugmode=False, progress_callback=None):
 		'Performs Matched Filtering with every template in the templatebank.'
 		if not isinstance(templatebank, TemplateBank):
 			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
@@ -75,6 +112,39 @@ class Data:
 		if debugmode: connection.update_mpi()
 		connection.Matched_Filter_templatebank(self, templatebank)
 
+	def detect(self, templatebank, list_of_resultfiles=None, debugmode=False, progress_callback=None):
+		'Checks only whether any template matches better than the match_threshold, trying the templates that matched best in list_of_resultfiles (earlier results) first.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		connection = MPIConnection()
+		if debugmode: connection.update_mpi()
+		connection.Detect(self, templatebank, list_of_resultfiles)
+
+	def hierarchical_search(self, templatebank, debugmode=False, progress_callback=None):
+		'Searches the best matching template parameters, starting with the templatebank as coarse bank and creating finer templates around the best matches.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		connection = MPIConnection()
+		if debugmode: connection.update_mpi()
+		connection.Hierarchical_Search(self, templatebank)
+
+	def regenerate_merger_plots(self, templatebank, names=None, debugmode=False):
+		'Creates the merger plots again from the saved results of the last matched filtering (e.g. after changing the settings for merger plots), without filtering.'
+		connection = MPIConnection()
+		if debugmode: connection.update_mpi()
+		connection.Regenerate_Merger_Plots(self, templatebank, names)
+
+	def matched_filter_live(self, templatebank, threshold=None, debugmode=False, progress_callback=None):
+		'Performs Matched Filtering with every template in the templatebank while the data file is still being recorded.'
+		if not isinstance(templatebank, TemplateBank):
+			raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+		mkdir(self.savepath, relative=False)
+		connection = MPIConnection()
+		if debugmode: connection.update_mpi()
+		connection.Matched_Filter_live(self, templatebank, threshold)
+
 	def set_datapath(self, newpath):
 		self.datapath = newpath
 
@@ -106,9 +176,13 @@ class MPIConnection:
 		self.client = docker.from_env()
 		self.volumes = {}     # style: {output_host: {'bind': output_container, 'mode': 'rw'}}
 		self.commands = []
-		self.script = '''python -c 'import mics_pycbc_interface as mpi; '''
+		self.manifest = {}    # the job, see run_manifest in mics_pycbc_interface
 		self.add_read_dir(os.getcwd(), '/input/mf/')
+		self.add_output_dir(JOBS_DIR, '/jobs/')
+		mkdir(RESAMPLE_CACHE_DIR, relative=False)
+		self.add_output_dir(RESAMPLE_CACHE_DIR, '/00_resampled/')
 		self.commands.append('cp /input/mf/config.ini /')
+		self.update_mpi()   # the published image has an older mics_pycbc_interface baked in, without run_manifest and serve_jobs
 		
 	def add_output_dir(self, output_host, output_container):
 		'Bind-mounts a directory from host to the container to (read and) write files into.'
@@ -120,44 +194,65 @@ class MPIConnection:
 
 	def transfer_objects(self, data, templatebank):
 		'Transfer a Data and a TemplateBank object from the templatebank_handler to mics_pycbc_interface inside the container.'
+		# Whether the data file is loaded inside the container depends on the task (not for live matched filtering).
 		# Data
-		savepath_container = '/output/'+data.shortname+'/'
-		self.add_output_dir(data.savepath, savepath_container)
-		if data.datapath != data.savepath:
-			datapath_container = '/input/'+data.shortname+'/'
-			self.add_read_dir(data.datapath, datapath_container)
-		self.script += 'data = mpi.Data("'+self.volumes[data.datapath]['bind']+'","'+data.filename+'","'+self.volumes[data.savepath]['bind']+'",'+str(data.preferred_srate)+','+str(data.segment_duration)+','+str(data.flag_show)+'); '
+		self.manifest['data'] = [self.transfer_data(data)]
 		# TemplateBank
-		list_of_bankpaths = list(set(templatebank.list_of_bankpaths).difference([data.datapath, data.savepath]))
+		self.transfer_templatebank(templatebank)
+
+	def transfer_data(self, data, distinction=''):
+		'Mount the directories of a Data object into the container and return it as manifest entry (with the paths inside the container).'
+		self.add_output_dir(data.savepath, '/output/'+data.shortname+distinction+'/')
+		if not data.datapath in self.volumes:
+			self.add_read_dir(data.datapath, '/input/'+data.shortname+distinction+'/')
+		return {'datapath': self.volumes[data.datapath]['bind'], 'filename': data.filename, 'savepath': self.volumes[data.savepath]['bind'],
+			'preferred_srate': data.preferred_srate, 'segment_duration': data.segment_duration, 'flag_show': data.flag_show}
+
+	def transfer_templatebank(self, templatebank):
+		'Mount the directories of a TemplateBank object into the container and add it to the manifest.'
+		list_of_bankpaths = [bankpath for bankpath in set(templatebank.list_of_bankpaths) if not bankpath in self.volumes]
 		list_of_bankpaths_both = [(bankpath_host,'/input/templatebank/'+Path(bankpath_host).parts[-1]+'_'+str(distinction)+'/') for distinction, bankpath_host in enumerate(list_of_bankpaths)]  # distinction because we really need unique names for different paths
 		for bankpath_both in list_of_bankpaths_both:
 			self.add_read_dir(bankpath_both[0], bankpath_both[1])
-		self.script += 'templatebank = mpi.TemplateBank(); '
+		# every bankpath is listed once, the templates only refer to its index
+		bankpaths = []
+		templates = []
 		for template in templatebank.list_of_templates:
-			self.script += 'templatebank.add_template("'+self.volumes[template.bankpath]['bind']+'","'+template.filename+'"); '		
+			bankpath = self.volumes[template.bankpath]['bind']
+			if not bankpath in bankpaths:
+				bankpaths.append(bankpath)
+			templates.append([bankpaths.index(bankpath), template.filename, template.row])
+		self.manifest['templatebank'] = {'bankpaths': bankpaths, 'templates': templates}
 
 	def run(self):
-		'Running the prepared commands and script inside the container and clearing them.'
-		# start container
-		container = self.client.containers.run("mdaamkit/mpi", detach=True, tty=True, volumes=self.volumes) 
-			# tty=True is necessary to keep the container running even if it has no jobs to do.
-			# remove=True could be used to auto-remove the container after it has finished running
-		# run code in container
-		for command in self.commands:
-			container.exec_run(command)
-		self.script += ''' ' '''
-		std = container.exec_run(self.script, demux=True)
+		'Running the prepared commands and the job of the manifest inside the container and clearing them.'
+		if WARM_CONTAINER:
+			std = warm_container(self.client).run(self.volumes, self.commands, self.manifest)
+		else:
+			name = write_manifest(self.manifest)
+			# start container
+			container = self.client.containers.run("mdaamkit/mpi", detach=True, tty=True, volumes=self.volumes) 
+				# tty=True is necessary to keep the container running even if it has no jobs to do.
+				# remove=True could be used to auto-remove the container after it has finished running
+			# run code in container
+			for command in self.commands:
+				container.exec_run(command)
+			std = container.exec_run('''python -c 'import mics_pycbc_interface as mpi; mpi.run_manifest("/jobs/'''+name+'''.json")' ''', demux=True)
+			# stop container and cleanup
+			container.stop()
+			self.client.containers.prune()
+			os.remove(JOBS_DIR+name+'.json')
 		if debugmode: print(std)
-		# stop container and cleanup (prepare for restart)
-		container.stop()
-		self.client.containers.prune()
+		# cleanup (prepare for restart)
 		self.volumes = {}
 		self.commands = []
-		self.script = '''python -c 'import mics_pycbc_interface as mpi; '''
+		self.manifest = {}
 
 	def update_mpi(self):
 		'Update mpi without building a new docker image.'
-		self.commands.append('cp /input/mf/mics_pycbc_interface.py /')
+		command = 'cp /input/mf/mics_pycbc_interface.py /'
+		if not command in self.commands:
+			self.commands.append(command)
 
 
 	### finally composing everything (these method names are capitalized)
@@ -166,22 +261,230 @@ class MPIConnection:
 	def Matched_Filter_templatebank(self, data, templatebank):
 		'Composing a Matched Filtering with every template in the templatebank.'
 		self.transfer_objects(data, templatebank)
-		self.script += 'mpi.matched_filter_templatebank( data, templatebank ); '
+		self.manifest['task'] = 'matched_filter_templatebank'
 		self.run()
 
-	def Create_Templates(self, parameters, bankpath_host, basename, attribute, freq_domain, time_domain):
+	def Detect(self, data, templatebank, list_of_resultfiles=None):
+		'Composing a detection: matched filtering in the order of earlier results until the first template above the match_threshold.'
+		self.transfer_objects(data, templatebank)
+		self.manifest['task'] = 'detect'
+		if list_of_resultfiles is not None:
+			list_of_resultfiles_container = []
+			for distinction, resultfile in enumerate(list_of_resultfiles):
+				resultpath, resultname = os.path.split(resultfile)
+				resultpath += '/'
+				if not resultpath in self.volumes:
+					self.add_read_dir(resultpath, '/input/prior_'+str(distinction)+'/')
+				list_of_resultfiles_container.append(self.volumes[resultpath]['bind']+resultname)
+			self.manifest['list_of_resultfiles'] = list_of_resultfiles_container
+		self.run()
+
+	def Hierarchical_Search(self, data, templatebank):
+		'Composing a hierarchical search starting with the templatebank as coarse template bank.'
+		self.transfer_objects(data, templatebank)
+		self.manifest['task'] = 'hierarchical_search'
+		self.run()
+
+	def Regenerate_Merger_Plots(self, data, templatebank, names=None):
+		'Composing the merger plots from saved results of an earlier matched filtering.'
+		self.transfer_objects(data, templatebank)
+		self.manifest['task'] = 'regenerate_merger_plots'
+		self.manifest['names'] = names
+		self.run()
+
+	def Matched_Filter_batch(self, list_of_data, templatebank):
+		'Composing a Matched Filtering of several data files with every template in the templatebank (loaded once) in a single container.'
+		self.manifest['data'] = [self.transfer_data(data, '_'+str(distinction)) for distinction, data in enumerate(list_of_data)]
+		self.transfer_templatebank(templatebank)
+		self.manifest['task'] = 'matched_filter_batch'
+		self.run()
+
+	def Matched_Filter_live(self, data, templatebank, threshold=None):
+		'Composing a live Matched Filtering of a recording that is still being written with every template in the templatebank.'
+		self.transfer_objects(data, templatebank)
+		self.manifest['task'] = 'matched_filter_live'
+		self.manifest['threshold'] = threshold   # None means LIVE_THRESHOLD of the config.ini
+		self.run()
+
+	def Create_Templates(self, parameters, bankpath_host, basename, attribute, freq_domain, time_domain, packed=False):
 		'Creates templates for further use in matched filtering (freq_domain) or as signals (time_domain).'
 		# parameters should be a numpy array of dim 2xN; flag_Mr, freq_domain and time_domain should be boolean.
 		self.add_output_dir(bankpath_host, '/output')
-		transfer_file = 'parameters.txt'
-		parameters.tofile(bankpath_host+transfer_file)
-		self.script += 'import numpy as np; '
-		self.script += 'parameters = np.fromfile("/output/'+transfer_file+'").reshape((2,-1)); '
-		self.script += 'mpi.create_templates(parameters, "/output/", "'+basename+'", "'+str(attribute)+'", '+str(freq_domain)+', '+str(time_domain)+'); '
+		self.manifest.update({'task': 'create_templates', 'parameters': np.asarray(parameters, dtype=np.float64).tolist(), 'bankpath': '/output/', 'basename': basename,
+			'attribute': str(attribute), 'freq_domain': bool(freq_domain), 'time_domain': bool(time_domain), 'packed': bool(packed)})
+		self.run()
+
+	def Pack_Templates(self, bankpath_host, filename):
+		'Packs all .hdf templates in bankpath_host into a single packed template bank.'
+		self.add_output_dir(bankpath_host, '/output')
+		self.manifest.update({'task': 'pack_templates', 'bankpath': '/output/', 'filename': filename})
 		self.run()
 
 
 
+### Job manifests
+#   -------------
+
+# A job for the container is described by a manifest: a small json-file in JOBS_DIR (mounted as /jobs/) with the task, the data,
+# the template bank (each bankpath once, the templates only by index, filename and row) and the settings. It is read by mpi.run_manifest.
+# So the command to start a job is always the same short one, no matter how large the template bank is.
+# run_manifest only exists in the mics_pycbc_interface.py of the MatchedFilter directory, not in the one of the published image.
+# That is why MPIConnection always copies it into the container before the first job.
+
+_job_numbers = itertools.count()
+
+def write_manifest(manifest):
+	'Write the manifest of a job into JOBS_DIR and return its name (without .json).'
+	mkdir(JOBS_DIR, relative=False)
+	name = str(os.getpid())+'_'+str(next(_job_numbers))
+	with open(JOBS_DIR+name+'.json.tmp', 'w') as jobfile:
+		json.dump(manifest, jobfile)
+	os.replace(JOBS_DIR+name+'.json.tmp', JOBS_DIR+name+'.json')  # so the container never reads a half-written manifest
+	return name
+
+
+### Warm worker container
+#   ----------------------
+
+# Starting a container and importing pycbc takes several seconds, which used to be paid for every job.
+# With warm_container = True (section 'performance' of config.ini), one container keeps running between jobs with mics_pycbc_interface imported (mpi.serve_jobs).
+# MPIConnection.run() hands it the manifest as a job file in JOBS_DIR and waits for the output.
+# The mounts of a running container can not be changed. So if a job needs a directory that is not mounted (at the same place), the container is restarted
+# with the mounts of the job and those of the old container that do not collide. It is also restarted if the settings in config.ini or mics_pycbc_interface.py changed.
+# The commands of MPIConnection (copying config.ini and the current mics_pycbc_interface.py into the container) run before serve_jobs.
+# Without jobs for container_idle_timeout seconds, the container stops itself. It is started again with the next job (also if it died).
+
+_warm_container = None
+
+def warm_container(client):
+	'Return the worker container (there is only one).'
+	global _warm_container
+	if _warm_container is None:
+		_warm_container = WarmContainer(client)
+	return _warm_container
+
+class WarmContainer:
+	def __init__(self, client):
+		self.client = client
+		self.container = None
+		self.volumes = {}
+		self.commands = []
+		self.version = None         # hash of the settings and of mics_pycbc_interface.py when the container was started (see current_version)
+		self.lock = threading.Lock()  # the GUI may send jobs from several threads, but they run one after the other
+
+	def running(self):
+		'Whether the container is (still) running.'
+		if self.container is None:
+			return False
+		try:
+			self.container.reload()
+		except docker.errors.NotFound:
+			return False
+		return self.container.status == 'running'
+
+	def fits(self, volumes):
+		'Whether every volume is mounted in the running container at the same place (and writable, if necessary).'
+		for host, volume in volumes.items():
+			mounted = self.volumes.get(host)
+			if mounted is None or mounted['bind'] != volume['bind'] or (volume['mode'] == 'rw' and mounted['mode'] != 'rw'):
+				return False
+		return True
+
+	def start(self, volumes, commands):
+		'(Re)start the container with volumes and the volumes of the old container that do not collide with them.'
+		self.stop()
+		binds = [volume['bind'] for volume in volumes.values()]
+		merged = {host: volume for host, volume in self.volumes.items() if not host in volumes and not volume['bind'] in binds}
+		merged.update(volumes)
+		mkdir(JOBS_DIR, relative=False)
+		for filename in os.listdir(JOBS_DIR):  # leftovers of an old container
+			os.remove(JOBS_DIR+filename)
+		serve = '''python -c "import mics_pycbc_interface as mpi; mpi.serve_jobs('/jobs/', '''+str(CONTAINER_IDLE_TIMEOUT)+''')"'''
+		self.container = self.client.containers.run("mdaamkit/mpi", ['sh', '-c', ' && '.join(commands+[serve])], detach=True, volumes=merged, name=CONTAINER_NAME)
+			# the container stops (and is removed with the next start) as soon as serve_jobs returns
+		self.volumes = merged
+		self.commands = list(commands)
+		self.version = self.current_version()
+
+	def stop(self):
+		'Stop and remove the container (also one left over from an earlier start of the MatchedFilter).'
+		try:
+			self.client.containers.get(CONTAINER_NAME).remove(force=True)
+		except docker.errors.NotFound:
+			pass
+		self.container = None
+
+	def current_version(self):
+		'Hash of what the running container depends on: mics_pycbc_interface.py and the settings in config.ini that mpi reads.'
+		# Not the modification times: the GUI writes config.ini every time a directory is chosen, which would restart the container each time.
+		sha = hashlib.sha1()
+		if os.path.isfile('mics_pycbc_interface.py'):
+			with open('mics_pycbc_interface.py', 'rb') as mpifile:
+				sha.update(mpifile.read())
+		settings = ConfigParser()
+		settings.read('config.ini')
+		for section in settings.sections():
+			if section in ['main', 'default']:  # only the paths and the state of the GUI; mpi just reads debugmode
+				continue
+			sha.update(repr((section, sorted(settings.items(section)))).encode())
+		sha.update(settings.get('main', 'debugmode', fallback='').encode())
+		return sha.hexdigest()
+
+	def submit(self, manifest):
+		'Write the manifest as a job file and wait for its output. None, if the container stopped before finishing it.'
+		name = write_manifest(manifest)
+		polls = 0
+		while not os.path.isfile(JOBS_DIR+name+'.done'):
+			polls += 1
+			if polls % 10 == 0 and not self.running():  # asking docker is much slower than looking for the file
+				return None
+			time.sleep(0.2)
+		with open(JOBS_DIR+name+'.done') as donefile:
+			output = donefile.read()
+		os.remove(JOBS_DIR+name+'.done')
+		return output
+
+	def run(self, volumes, commands, manifest):
+		'Run the job of the manifest in the container (after starting or restarting it, if necessary) and return its output.'
+		with self.lock:
+			for attempt in range(2):
+				if not self.running() or not self.fits(volumes) or commands != self.commands or self.current_version() != self.version:
+					self.start(volumes, commands)
+				output = self.submit(manifest)
+				if output is not None:
+					return output
+				print('The worker container stopped while running a job. Starting it again.')
+			raise RuntimeError('The worker container stopped twice while running the same job.')
+
+
+
+def matched_filter_batch(list_of_data, templatebank, debugmode=False):
+	'Performs Matched Filtering of every Data object in list_of_data with every template in the templatebank, all in one container.'
+	if not isinstance(templatebank, TemplateBank):
+		raise TypeError('templatebank has to be an instance of TemplateBank class but has type: ' + str(type(templatebank)))
+	if not list_of_data:
+		return
+	for data in list_of_data:
+		mkdir(data.savepath, relative=False)
+	connection = MPIConnection()
+	if debugmode: connection.update_mpi()
+	connection.Matched_Filter_batch(list_of_data, templatebank)
+
+def data_from_directory(path, ending='.wav'):
+	'Return a list of Data objects for every file in path ending with ending.'
+	return [Data(path, filename) for filename in sorted(os.listdir(path)) if filename.endswith(ending)]
+
+def load_results(filename):
+	'Load the results of a matched filtering from a .npz-file (or an old .dat-file) as a dictionary of columns. (Same as in mics_pycbc_interface.)'
+	if filename.endswith('.npz'):
+		with np.load(filename) as f:
+			return {name: f[name] for name in f.files}
+	columns = ['templatename', 'maxmatch', 'maxtime', 'm1', 'm2', 'M', 'r', 'Mc']
+	results = np.loadtxt(filename, dtype={'names': columns, 'formats': ['U256']+['f8']*7}, ndmin=1)
+	results = {name: results[name] for name in columns}
+	results['order'] = np.argsort(results['maxmatch'], kind='stable')[::-1]
+	return results
+
 def mkdir( dirname, relative=True ):
 	'Creates the directory dirname.'
 	if relative:
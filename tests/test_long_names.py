@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+from pycbc import types
+
+import mics_pycbc_interface as mpi
+
+# Template names used to be cut to 40 characters in the results. These tests filter a recording with a template of a longer name.
+
+LONG_NAME = 'template_with_a_really_long_descriptive_name_mm_30-25_v2'
+SHORT_NAME = 'mm_12-10'
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+	'A template bank with a long and a short named template and a recording of the long one.'
+	monkeypatch.setattr(mpi, 'RESAMPLE_CACHE_MB', 0)
+	monkeypatch.setattr(mpi, 'MERGER_PLOT_WORKERS', 0)
+	bankpath = str(tmp_path/'bank')+'/'
+	savepath = str(tmp_path/'out')+'/'
+	mpi.mkdir(bankpath, relative=False)
+	mpi.mkdir(savepath, relative=False)
+	for name, m1, m2 in [(LONG_NAME, 30., 25.), (SHORT_NAME, 12., 10.)]:
+		hp_freq, hp = mpi.make_template(m1, m2)
+		mpi.save_FrequencySeries(hp_freq, bankpath+name+'.hdf', m1, m2)
+		if name == LONG_NAME:
+			signal = np.concatenate([np.zeros(2*len(hp)), np.asarray(hp), np.zeros(2*len(hp))])
+			signal += 0.01*np.max(np.abs(signal))*np.random.default_rng(1).standard_normal(len(signal))
+			types.TimeSeries(signal, delta_t=hp.delta_t).save_to_wav(str(tmp_path)+'/rec.wav')
+	templatebank = mpi.TemplateBank()
+	for name in [LONG_NAME, SHORT_NAME]:
+		templatebank.add_template(bankpath, name+'.hdf')
+	data = mpi.Data(str(tmp_path)+'/', 'rec.wav', savepath, 4096, 1, False)
+	return data, templatebank
+
+
+def test_results_keep_long_names(setup):
+	data, templatebank = setup
+	assert len(LONG_NAME) > 40
+	mpi.matched_filter_templatebank(data, templatebank, workers=1)
+	results = mpi.load_results(data.savepath+mpi.RESULTS_FILENAME)
+	assert list(results['templatename']) == [LONG_NAME, SHORT_NAME]
+	assert results['templatename'][results['order'][0]] == LONG_NAME
+	if mpi.RESULTS_TEXT_EXPORT:
+		dat = mpi.load_results(data.savepath+'00_matched_filtering_results.dat')
+		assert list(dat['templatename']) == [LONG_NAME, SHORT_NAME]
+
+
+def test_regenerate_merger_plots_of_long_names(setup):
+	data, templatebank = setup
+	mpi.matched_filter_templatebank(data, templatebank, workers=1)
+	plot = data.savepath+'plot_'+data.shortname+'_'+LONG_NAME+'.png'
+	if os.path.isfile(plot): os.remove(plot)
+	mpi.regenerate_merger_plots(data, templatebank, [LONG_NAME])
+	assert os.path.isfile(plot)
+	os.remove(plot)
+	mpi.regenerate_merger_plots(data, templatebank)
+	assert os.path.isfile(plot)
+
+
+def test_regenerate_merger_plots_from_cut_names(setup, capsys):
+	'Results saved by older versions have the names cut to 40 characters; the templates are found by their index in the bank.'
+	data, templatebank = setup
+	mpi.matched_filter_templatebank(data, templatebank, workers=1)
+	results = mpi.load_results(data.savepath+mpi.RESULTS_FILENAME)
+	results['templatename'] = np.array([name[:40] for name in results['templatename']])
+	np.savez(data.savepath+mpi.RESULTS_FILENAME, **results)
+	plot = data.savepath+'plot_'+data.shortname+'_'+LONG_NAME+'.png'
+	os.remove(plot)
+	mpi.regenerate_merger_plots(data, templatebank)
+	assert os.path.isfile(plot)
+	mpi.regenerate_merger_plots(data, templatebank, ['no_such_template'])
+	assert 'no_such_template' in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('cut', [False, True])
+def test_detection_prior_of_long_names(setup, tmp_path, cut):
+	'The prior of earlier results (also with names cut to 40 characters by older versions) puts the long named template first.'
+	data, templatebank = setup
+	templatebank.list_of_templates.reverse()   # without the prior, the short named template would be filtered first
+	priorfile = str(tmp_path)+'/prior.dat'
+	with open(priorfile, 'w') as f:
+		f.write((LONG_NAME[:40] if cut else LONG_NAME)+' 0.9 1.0 30 25 55 0.83 23.9\n'+SHORT_NAME+' 0.1 1.0 12 10 22 0.83 9.6\n')
+	hit, checked, skipped = mpi.detect(data, templatebank, [priorfile], threshold=0.)
+	assert hit[0].shortname == LONG_NAME
+	assert (checked, skipped) == (1, 1)
+	detection = np.loadtxt(data.savepath+'00_detection.dat', dtype=str)
+	assert detection[1] == LONG_NAME
@@ -0,0 +1,79 @@
+import sys
+import os
+import time
+import numpy as np
+
+
+### About this validation
+#   ---------------------
+
+# Compares the matched filtering in single precision (float32/complex64, see 'precision' in the section 'performance' of the config.ini)
+# with double precision on a reference template bank and real recordings: how much the matches, times and phases of the best matches differ,
+# whether the same template matches best and how much memory and time the data and the filtering take.
+# It needs pycbc, so run it on linux (or inside the docker container) from the MatchedFilter directory, since mpi reads the config.ini from there:
+#
+#     python tools/precision/validate_precision.py path/to/templatebank/ recording1.wav [recording2.wav ...]
+
+sys.path.insert(0, os.getcwd())
+import mics_pycbc_interface as mpi
+
+mpi.config.set('mergerplots', 'create_all', 'False')   # no merger plots, we only want to compare numbers
+precisions = ['double', 'single']
+
+
+def load_templatebank(bankpath):
+	'TemplateBank with all .hdf-files and packed template banks in bankpath.'
+	templatebank = mpi.TemplateBank()
+	for filename in sorted(os.listdir(bankpath)):
+		if filename.endswith('.hdf'):
+			templatebank.add_template(bankpath, filename)
+		elif filename.endswith(mpi.PACKED_EXTENSION):
+			templatebank.add_packed_bank(bankpath, filename)
+	return templatebank
+
+def validate(filename, templatebank):
+	'Filter the recording with every template in both precisions and print the differences. Returns the largest differences.'
+	datapath, filename = os.path.split(os.path.abspath(filename))
+	datapath += '/'
+	results = {}
+	for precision in precisions:
+		data = mpi.Data(datapath, filename, datapath, 4096, 1, False, mpi.RESAMPLER, precision)
+		memory = (data.segment_spectra.nbytes+sum(np.asarray(segment).nbytes for segment in data.segments))/1024**2
+		start = time.time()
+		maxmatches = np.array([mpi.matched_filter_single(data, template)[4] for template in templatebank.list_of_templates], dtype=np.float64)
+		results[precision] = memory, time.time()-start, maxmatches
+		mpi.template_cache.clear()   # so both precisions start without cached templates
+
+	_, _, double = results['double']
+	_, _, single = results['single']
+	match_diff = np.abs(single[:,0]-double[:,0])
+	time_diff = np.abs(single[:,1]-double[:,1])
+	phase_diff = np.abs(np.angle(np.exp(1j*(single[:,2]-double[:,2]))))
+	same_best = np.argmax(single[:,0]) == np.argmax(double[:,0])
+	top = min(10, len(double))
+	same_top = np.array_equal(np.argsort(-single[:,0], kind='stable')[:top], np.argsort(-double[:,0], kind='stable')[:top])
+
+	print()
+	print(filename+' ('+str(len(templatebank.list_of_templates))+' templates, '+str(len(data.segments))+' segments)')
+	print('precision   data in memory (MB)   filtering (s)')
+	for precision in precisions:
+		memory, duration, _ = results[precision]
+		print(f'{precision:<12}{memory:>20.1f}{duration:>16.3f}')
+	print(f'max |match diff|: {np.max(match_diff):.2e} (mean {np.mean(match_diff):.2e})')
+	print(f'max |time diff| (s): {np.max(time_diff):.2e}, templates with another time of best match: {np.count_nonzero(time_diff > 0)}')
+	print(f'max |phase diff| (rad): {np.max(phase_diff):.2e}')
+	print('same best template: '+str(same_best)+', same '+str(top)+' best templates in the same order: '+str(same_top))
+	return np.max(match_diff), np.max(time_diff), same_best
+
+
+### Start validation
+
+if len(sys.argv) < 3:
+	print('usage: python tools/precision/validate_precision.py path/to/templatebank/ recording1.wav [recording2.wav ...]')
+	sys.exit(1)
+bankpath = os.path.abspath(sys.argv[1])+'/'
+templatebank = load_templatebank(bankpath)
+worst = [validate(filename, templatebank) for filename in sys.argv[2:]]
+print()
+print('Summary over '+str(len(worst))+' recordings:')
+print(f'max |match diff|: {max(w[0] for w in worst):.2e}, max |time diff| (s): {max(w[1] for w in worst):.2e}, same best template in all: {all(w[2] for w in worst)}')
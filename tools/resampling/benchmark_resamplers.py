@@ -0,0 +1,65 @@
+import sys
+import os
+import time
+import numpy as np
+
+
+### About this benchmark
+#   --------------------
+
+# Compares the resampling converters of the MatchedFilter (see 'resampler' in the section 'performance' of the config.ini) on real recordings:
+# how long loading and resampling takes and how much the matched filtering results differ from the ones with sinc_best.
+# It needs pycbc, so run it on linux (or inside the docker container) from the MatchedFilter directory, since mpi reads the config.ini from there:
+#
+#     python tools/resampling/benchmark_resamplers.py path/to/templatebank/ recording1.wav [recording2.wav ...]
+
+sys.path.insert(0, os.getcwd())
+import mics_pycbc_interface as mpi
+
+mpi.RESAMPLE_CACHE_MB = 0   # we want to measure the resampling, not the cache
+reference = 'sinc_best'
+
+
+def load_templatebank(bankpath):
+	'TemplateBank with all .hdf-files and packed template banks in bankpath.'
+	templatebank = mpi.TemplateBank()
+	for filename in sorted(os.listdir(bankpath)):
+		if filename.endswith('.hdf'):
+			templatebank.add_template(bankpath, filename)
+		elif filename.endswith(mpi.PACKED_EXTENSION):
+			templatebank.add_packed_bank(bankpath, filename)
+	return templatebank
+
+def benchmark(filename, templatebank):
+	'Time loading and resampling with every converter and compare the best matches of every template to the ones with the reference converter.'
+	datapath, filename = os.path.split(os.path.abspath(filename))
+	datapath += '/'
+	results = {}
+	for converter in mpi.RESAMPLERS:
+		start = time.time()
+		data = mpi.Data(datapath, filename, datapath, 4096, 1, False, converter)
+		duration = time.time()-start
+		maxmatches = np.array([mpi.matched_filter_single(data, template)[4] for template in templatebank.list_of_templates])
+		results[converter] = duration, maxmatches
+
+	print()
+	print(filename+' ('+str(len(templatebank.list_of_templates))+' templates)')
+	print('converter       load+resample (s)   max |match diff|   max |time diff| (s)   same best template')
+	best_reference = np.argmax(results[reference][1][:,0])
+	for converter in mpi.RESAMPLERS:
+		duration, maxmatches = results[converter]
+		match_diff = np.max(np.abs(maxmatches[:,0]-results[reference][1][:,0]))
+		time_diff = np.max(np.abs(maxmatches[:,1]-results[reference][1][:,1]))
+		same_best = np.argmax(maxmatches[:,0]) == best_reference
+		print(f'{converter:<16}{duration:>17.3f}{match_diff:>19.2e}{time_diff:>22.2e}   {same_best}')
+
+
+### Start benchmark
+
+if len(sys.argv) < 3:
+	print('usage: python tools/resampling/benchmark_resamplers.py path/to/templatebank/ recording1.wav [recording2.wav ...]')
+	sys.exit(1)
+bankpath = os.path.abspath(sys.argv[1])+'/'
+templatebank = load_templatebank(bankpath)
+for filename in sys.argv[2:]:
+	benchmark(filename, templatebank)